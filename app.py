@@ -1,281 +1,2503 @@
 #!/usr/bin/env python
+import base64
+import bisect
 import json
 import time
 import os
-import random
+import re
+import socket
+import contextvars
+import gzip
+import hashlib
+import hmac
+import http.client
+import mimetypes
+import tempfile
+import threading
 import warnings
 from urllib.parse import parse_qs, urlparse, urlencode
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from http.cookiejar import DefaultCookiePolicy
 
+import click
 import requests
-import werkzeug
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
 from flask import (
     Flask,
+    Response,
+    g,
     request,
     make_response,
     jsonify,
-    send_file,
     abort,
     redirect,
-    send_from_directory,
 )
 from flask.views import MethodView
 from flask_sqlalchemy import SQLAlchemy
-from decouple import config
+from werkzeug.http import unquote_etag
+from sqlalchemy.exc import IntegrityError
+from decouple import config, Csv
 import rollbar
 
+try:
+    import brotli
+except ImportError:
+    # Only used to serve smaller static assets than gzip does.
+    brotli = None
+
+# For when process_started() can't tell.
+imported = time.time()
+
+
+DEBUG = config("DEBUG", default=False)
+# Overridable so everything can be pointed at a local stand-in.
+GITHUB_API_URL = config("GITHUB_API_URL", default="https://api.github.com")
+GITHUB_GRAPHQL_URL = config("GITHUB_GRAPHQL_URL", default=GITHUB_API_URL + "/graphql")
+GITHUB_REQUEST_TIMEOUT = config("GITHUB_REQUEST_TIMEOUT", default=10, cast=float)
+# The most time, in seconds, all the upstream calls of a /shas or /culprits
+# request may take together. Each call's timeout is whatever is left of it
+# (or GITHUB_REQUEST_TIMEOUT if that's less).
+REQUEST_DEADLINE = config("REQUEST_DEADLINE", default=15, cast=float)
+# After this many failures in a row (connection errors, 5xx, and timeouts
+# of calls that had all of GITHUB_REQUEST_TIMEOUT) a deployment URL, or
+# GitHub, isn't tried again for a while.
+DEPLOYMENT_BREAKER_THRESHOLD = config(
+    "DEPLOYMENT_BREAKER_THRESHOLD", default=3, cast=int
+)
+GITHUB_BREAKER_THRESHOLD = config("GITHUB_BREAKER_THRESHOLD", default=5, cast=int)
+CIRCUIT_BREAKER_OPEN_SECONDS = config(
+    "CIRCUIT_BREAKER_OPEN_SECONDS", default=30, cast=float
+)
+GITHUB_REQUEST_HEADERS = {
+    "User-Agent": config(
+        "REQUESTS_USER_AGENT", default="whatsdeployed (https://whatsdeployed.io)"
+    )
+}
+# How many upstream requests (GitHub API and deployment URLs) each process
+# has in flight at the same time, for all the requests it's handling
+# together. It's the size of the one thread pool they all share, so make it
+# about how many requests a process handles at once times how many upstream
+# requests each makes in parallel; if it's too small they queue up.
+UPSTREAM_MAX_WORKERS = config("UPSTREAM_MAX_WORKERS", default=32, cast=int)
+# Connection pooling for the shared upstream HTTP client. POOL_CONNECTIONS is
+# how many distinct hosts to keep pools for, POOL_MAXSIZE how many kept-alive
+# connections to keep per host.
+UPSTREAM_POOL_CONNECTIONS = config("UPSTREAM_POOL_CONNECTIONS", default=10, cast=int)
+UPSTREAM_POOL_MAXSIZE = config("UPSTREAM_POOL_MAXSIZE", default=20, cast=int)
+# Retries only apply to failed connects and 502/503/504 responses. Read
+# timeouts are never retried since that would multiply the wait.
+UPSTREAM_RETRIES = config("UPSTREAM_RETRIES", default=2, cast=int)
+UPSTREAM_RETRY_BACKOFF = config("UPSTREAM_RETRY_BACKOFF", default=0.2, cast=float)
+# Where to keep GitHub API responses (with their ETags) for conditional
+# requests. One of "memory", "database" or "none".
+GITHUB_CACHE_BACKEND = config("GITHUB_CACHE_BACKEND", default="memory")
+GITHUB_CACHE_MAX_BYTES = config(
+    "GITHUB_CACHE_MAX_BYTES", default=50 * 1024 * 1024, cast=int
+)
+# Things addressed by a git sha never change so they're kept until this
+# many bytes are stored, then the least recently used are evicted.
+PERMANENT_CACHE_MAX_BYTES = config(
+    "PERMANENT_CACHE_MAX_BYTES", default=20 * 1024 * 1024, cast=int
+)
+# Seconds to trust the stored tag index before checking GitHub for new
+# tags. Checking means getting every page of tags, if mostly as 304s, so
+# it's not free. With the webhook set up (see GITHUB_WEBHOOK_SECRET) this
+# can be much longer since new and deleted tags mark the index as stale.
+TAG_INDEX_MAX_AGE = config("TAG_INDEX_MAX_AGE", default=120, cast=int)
+# How many pages of recently closed pull requests to go through looking
+# for the ones merged as the deployed shas before asking GitHub about the
+# remaining shas one by one.
+CULPRITS_PULLS_MAX_PAGES = config("CULPRITS_PULLS_MAX_PAGES", default=3, cast=int)
+# Either "rest" or "graphql". The GraphQL API gets everything about all the
+# deployed shas in one query but requires a GITHUB_AUTH_TOKEN.
+CULPRITS_BACKEND = config("CULPRITS_BACKEND", default="rest")
+# Identical upstream requests made at the same time are only made once.
+# "process" coalesces within each process, "host" also across processes on
+# the same machine (with file locks) and "off" doesn't coalesce at all.
+SINGLE_FLIGHT = config("SINGLE_FLIGHT", default="process")
+SINGLE_FLIGHT_DIR = config(
+    "SINGLE_FLIGHT_DIR",
+    default=os.path.join(
+        tempfile.gettempdir(),
+        # Per user, so it can't be someone else's.
+        "whatsdeployed-singleflight-{}".format(getattr(os, "getuid", str)()),
+    ),
+)
+# In "host" mode, how old (in seconds) another process's result may be and
+# still be used by a process that was waiting for it.
+SINGLE_FLIGHT_MAX_AGE = config("SINGLE_FLIGHT_MAX_AGE", default=1.0, cast=float)
+# Keep precomputed /shas and /culprits responses for the most requested
+# shortlinks. Needs the refresher running (see the Procfile) to be useful.
+SNAPSHOTS = config("SNAPSHOTS", default=False, cast=bool)
+# Snapshots older than this (seconds) aren't served.
+SNAPSHOT_MAX_AGE = config("SNAPSHOT_MAX_AGE", default=120, cast=int)
+# Remember the sha of each deployment URL for this many seconds so busy
+# dashboards don't hammer the version endpoints. 0 means don't. For
+# DEPLOYMENT_CACHE_GRACE seconds after that the old sha is still used
+# while it's refreshed in the background.
+DEPLOYMENT_CACHE_TTL = config("DEPLOYMENT_CACHE_TTL", default=0, cast=float)
+DEPLOYMENT_CACHE_GRACE = config("DEPLOYMENT_CACHE_GRACE", default=30, cast=float)
+# Stop reading a deployment URL after this many bytes. A sha, or a
+# Dockerflow version.json, is much smaller than that.
+DEPLOYMENT_MAX_BYTES = config("DEPLOYMENT_MAX_BYTES", default=16 * 1024, cast=int)
+# How long browsers may use a /githubapi/ response without revalidating it.
+# With 0 they always revalidate, which is cheap thanks to the ETag.
+GITHUBAPI_MAX_AGE = config("GITHUBAPI_MAX_AGE", default=0, cast=int)
+# How many decoded shortlinks to keep in memory. They never change once
+# created so this only needs to be big enough for the popular ones.
+SHORTLINK_CACHE_SIZE = config("SHORTLINK_CACHE_SIZE", default=10000, cast=int)
+# The most shortlinks one /dashboard request may ask about.
+DASHBOARD_MAX_SHORTLINKS = config("DASHBOARD_MAX_SHORTLINKS", default=50, cast=int)
+GITHUB_AUTH_TOKEN = config("GITHUB_AUTH_TOKEN", default=None)
+# More tokens (comma separated) to spread the calls to GitHub over. Each
+# call uses whichever token has the most of its rate limit left.
+GITHUB_AUTH_TOKENS = config("GITHUB_AUTH_TOKENS", default="", cast=Csv())
+if GITHUB_AUTH_TOKEN:
+    GITHUB_AUTH_TOKENS.insert(0, GITHUB_AUTH_TOKEN)
+# When every token has run out, how many seconds a request may wait for
+# one to be reset before failing. By default it fails right away.
+GITHUB_RATE_LIMIT_MAX_WAIT = config("GITHUB_RATE_LIMIT_MAX_WAIT", default=0, cast=float)
+# The secret of the GitHub webhook that posts to /webhooks/github. Without
+# it that endpoint is disabled.
+GITHUB_WEBHOOK_SECRET = config("GITHUB_WEBHOOK_SECRET", default=None)
+if not GITHUB_AUTH_TOKENS:
+    warnings.warn("GITHUB_AUTH_TOKEN is NOT available. Worry about rate limits.")
+    if CULPRITS_BACKEND == "graphql":
+        warnings.warn("CULPRITS_BACKEND=graphql won't work without GITHUB_AUTH_TOKEN.")
+
+ROLLBAR_ACCESS_TOKEN = config("ROLLBAR_ACCESS_TOKEN", default=None)
+
+# Set static_folder=None to suppress the standard static server
+app = Flask(__name__, static_folder=None)
+app.config["SQLALCHEMY_DATABASE_URI"] = config(
+    "SQLALCHEMY_DATABASE_URI", "postgres://localhost/whatsdeployed"
+)
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = DEBUG
+db = SQLAlchemy(app)
+
+
+class UpstreamError(Exception):
+    """Something upstream failed in a way that should be shown to the user
+    as {"error": str(exception)}."""
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+
+# The Deadline of the request being handled, if any. Work submitted with
+# submit() gets it too.
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    token = current_deadline.set(Deadline(seconds))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def upstream_timeout():
+    """GITHUB_REQUEST_TIMEOUT or, if less, what's left of the deadline."""
+    current = current_deadline.get()
+    if current is None:
+        return GITHUB_REQUEST_TIMEOUT
+    remaining = current.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded("Ran out of time waiting for upstream responses")
+    return min(GITHUB_REQUEST_TIMEOUT, remaining)
+
+
+def has_full_timeout():
+    """Whether a call made now gets all of GITHUB_REQUEST_TIMEOUT, i.e. if
+    it times out that's upstream's fault and not the deadline's."""
+    current = current_deadline.get()
+    return current is None or current.remaining() >= GITHUB_REQUEST_TIMEOUT
+
+
+def submit(pool, function, *args, **kwargs):
+    """Like pool.submit() but the function runs in a copy of the caller's
+    context, so it sees the same current_deadline."""
+    return pool.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    """Remembers which upstreams (by key) have recently failed. After
+    'threshold' failures in a row, calls for that key fail right away for
+    'open_seconds'. After that one call is let through to try it again."""
+
+    def __init__(self, threshold, open_seconds):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.open_until = {}
+        self.trying = set()
+        self.rejected = 0
+
+    def call(self, key, function, *args, **kwargs):
+        self.check(key)
+        full_timeout = has_full_timeout()
+        try:
+            response = function(*args, **kwargs)
+        except BaseException as exception:
+            self.error(key, exception, full_timeout)
+            raise
+        self.record(key, response)
+        return response
+
+    def record(self, key, response):
+        """Count the response of a call let through by check()."""
+        if response.status_code >= 500:
+            self.failure(key)
+        else:
+            self.success(key)
+
+    def error(self, key, exception, full_timeout):
+        """Count what a call let through by check() raised. A timeout only
+        counts if the call had all of GITHUB_REQUEST_TIMEOUT, not just what
+        was left of a request's deadline."""
+        if isinstance(exception, requests.exceptions.Timeout):
+            failed = full_timeout
+        else:
+            failed = isinstance(exception, requests.exceptions.ConnectionError)
+        if failed:
+            self.failure(key)
+        else:
+            with self.lock:
+                self.trying.discard(key)
+
+    def check(self, key):
+        with self.lock:
+            until = self.open_until.get(key)
+            if until is None:
+                return
+            if time.time() < until or key in self.trying:
+                self.rejected += 1
+                raise CircuitOpen(
+                    "{} failed recently. Not trying again for {} seconds.".format(
+                        key, max(1, int(until - time.time()))
+                    )
+                )
+            self.trying.add(key)
+
+    def success(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+            self.open_until.pop(key, None)
+            self.trying.discard(key)
+
+    def failure(self, key):
+        with self.lock:
+            self.trying.discard(key)
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if self.failures[key] >= self.threshold:
+                self.open_until[key] = time.time() + self.open_seconds
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "open": sorted(
+                    k for k, until in self.open_until.items() if until > now
+                ),
+                "rejected": self.rejected,
+            }
+
+
+deployment_breaker = CircuitBreaker(
+    DEPLOYMENT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS
+)
+github_breaker = CircuitBreaker(GITHUB_BREAKER_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS)
+
+
+class Metrics:
+    """Counters and latency histograms, shown in the Prometheus text format
+    on /__metrics__. Recording one is a dict lookup under a lock."""
+
+    # Upper bounds, in seconds, of the histogram buckets.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> number
+        self.counters = defaultdict(int)
+        # (name, labels) -> [count per bucket..., count over the last, sum]
+        self.histograms = {}
+
+    def inc(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += 1
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def render(self, samples):
+        """Return the text for /__metrics__. 'samples' are more (name, type,
+        labels, value) to include, typically read from the various stats()."""
+        with self.lock:
+            samples = list(samples) + [
+                (name, "counter", dict(labels), value)
+                for (name, labels), value in self.counters.items()
+            ]
+            histograms = [
+                (name, dict(labels), list(histogram))
+                for (name, labels), histogram in self.histograms.items()
+            ]
+        for name, labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                samples.append(
+                    (name, "histogram", dict(labels, le=bound), cumulative, "_bucket")
+                )
+            samples.append((name, "histogram", labels, histogram[-1], "_sum"))
+            samples.append((name, "histogram", labels, cumulative, "_count"))
+
+        lines = []
+        typed = set()
+        for name, type_, labels, value, *suffix in sorted(
+            samples, key=lambda sample: sample[0]
+        ):
+            name = "whatsdeployed_" + name
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, type_))
+            name += "".join(suffix)
+            if labels:
+                name += "{%s}" % ",".join(
+                    '{}="{}"'.format(
+                        label,
+                        str(label_value)
+                        .replace("\\", "\\\\")
+                        .replace('"', '\\"')
+                        .replace("\n", "\\n"),
+                    )
+                    for label, label_value in labels.items()
+                )
+            lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# What to call the GitHub API calls in the metrics, by path.
+GITHUB_ROUTES = (
+    ("tags", re.compile(r"/repos/[^/]+/[^/]+/tags")),
+    ("comments", re.compile(r"/repos/[^/]+/[^/]+/issues/\d+/comments")),
+    ("pulls", re.compile(r"/repos/[^/]+/[^/]+/(pulls|commits/[^/]+/pulls)")),
+    ("compare", re.compile(r"/repos/[^/]+/[^/]+/compare/")),
+    ("commits", re.compile(r"/repos/[^/]+/[^/]+/commits")),
+)
+
+
+def upstream_route(url):
+    """Return what kind of upstream call a URL is, for the metrics."""
+    if url.startswith(GITHUB_GRAPHQL_URL):
+        return "graphql"
+    if url.startswith(GITHUB_API_URL):
+        path = url.replace(GITHUB_API_URL, "", 1)
+        for route, regex in GITHUB_ROUTES:
+            if regex.match(path):
+                return route
+        return "github"
+    return "deployment"
+
+
+class UpstreamClient:
+    """Thread-safe HTTP client shared by everything that talks to GitHub or
+    to the deployment URLs. Connections are pooled and kept alive per host
+    so repeated requests to api.github.com don't redo the TCP+TLS handshake."""
+
+    def __init__(
+        self,
+        pool_connections,
+        pool_maxsize,
+        retries,
+        backoff_factor,
+        timeout,
+    ):
+        # A function returning the timeout to use
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.reset()
+
+    def reset(self):
+        """Start over with a new session and no open connections."""
+        session = requests.Session()
+        # Never store cookies. Upstreams don't need them and it keeps the
+        # session free of shared mutable state between threads.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=Retry(
+                total=self.retries,
+                read=False,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.session = session
+        self.adapter = adapter
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        return self.request("GET", url, headers, timeout, **kwargs)
+
+    def post(self, url, headers=None, timeout=None, **kwargs):
+        return self.request("POST", url, headers, timeout, **kwargs)
+
+    def request(self, method, url, headers, timeout, **kwargs):
+        route = upstream_route(url)
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method,
+                url,
+                headers=headers,
+                timeout=timeout or self.timeout(),
+                **kwargs,
+            )
+        except requests.exceptions.Timeout:
+            metrics.inc("upstream_timeouts_total", route=route)
+            raise
+        except requests.exceptions.RequestException:
+            metrics.inc("upstream_errors_total", route=route)
+            raise
+        finally:
+            metrics.observe(
+                "upstream_request_duration_seconds",
+                time.perf_counter() - started,
+                route=route,
+            )
+        metrics.inc(
+            "upstream_responses_total", route=route, status=response.status_code
+        )
+        return response
+
+    def stats(self):
+        """Return, per host, how many requests were made and how many new
+        connections that took. The difference is connections reused."""
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts["{}://{}:{}".format(pool.scheme, pool.host, pool.port)] = {
+                "requests": pool.num_requests,
+                "connections": pool.num_connections,
+                "reused": max(0, pool.num_requests - pool.num_connections),
+            }
+        return hosts
+
+
+upstream = UpstreamClient(
+    pool_connections=UPSTREAM_POOL_CONNECTIONS,
+    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+    retries=UPSTREAM_RETRIES,
+    backoff_factor=UPSTREAM_RETRY_BACKOFF,
+    timeout=upstream_timeout,
+)
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the result of whichever of
+    them came first, instead of each making the same upstream request."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result()
+        try:
+            result = self.call(key, function, *args, **kwargs)
+        except BaseException as exception:
+            call.set_exception(exception)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def call(self, key, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    def stats(self):
+        return {
+            "mode": SINGLE_FLIGHT,
+            "in_flight": len(self.calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+class HostSingleFlight(SingleFlight):
+    """Like SingleFlight but the process that gets to make the call holds a
+    file lock while doing so and leaves its result behind, as JSON, for the
+    other processes that were waiting on that lock. The directory must be
+    private to the user running the app since results can be responses
+    about private repos. Files nobody has used for a while are removed."""
+
+    # Lock files are recreated on every call so they can go much sooner
+    # than this. It's only so a sweep never pulls one from under a call
+    # that's still going.
+    LOCK_MAX_AGE = 300
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, directory, max_age):
+        super().__init__()
+        self.directory = directory
+        self.max_age = max_age
+        self.coalesced_across_processes = 0
+        self.swept = time.time()
+        make_private_directory(directory)
+
+    def call(self, key, function, *args, **kwargs):
+        import fcntl
+
+        self.maybe_sweep()
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, name)
+        with open_private(path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    if time.time() - os.stat(path).st_mtime < self.max_age:
+                        with open(path) as f:
+                            result = load_shared_result(json.load(f))
+                        self.coalesced_across_processes += 1
+                        return result
+                except (OSError, ValueError, KeyError):
+                    pass
+                result = function(*args, **kwargs)
+                with open_private(path + ".tmp", "w") as f:
+                    json.dump(dump_shared_result(result), f)
+                os.replace(path + ".tmp", path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def maybe_sweep(self):
+        now = time.time()
+        if now - self.swept < self.SWEEP_INTERVAL:
+            return
+        self.swept = now
+        for entry in os.scandir(self.directory):
+            max_age = self.LOCK_MAX_AGE if entry.name.endswith(".lock") else 0
+            try:
+                if now - entry.stat().st_mtime > max(max_age, self.max_age):
+                    os.remove(entry.path)
+            except OSError:
+                # Another process got to it first.
+                pass
+
+    def stats(self):
+        stats = super().stats()
+        stats["coalesced_across_processes"] = self.coalesced_across_processes
+        return stats
+
+
+def make_private_directory(directory):
+    """Create the directory, readable only by this user, or make sure that
+    it already is. Raises RuntimeError if it belongs to someone else."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    stat = os.lstat(directory)
+    if not os.path.isdir(directory) or os.path.islink(directory):
+        raise RuntimeError("{} is not a directory".format(directory))
+    if stat.st_uid != os.getuid():
+        raise RuntimeError("{} belongs to another user".format(directory))
+    if stat.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+def open_private(path, mode):
+    """open() but, if it creates the file, only this user can read it."""
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode)
+
+
+def dump_shared_result(result):
+    """The JSON for a result of github_get() or fetch_content()."""
+    if isinstance(result, DeploymentResponse):
+        return {"deployment": list(result)}
+    return {
+        "status_code": result.status_code,
+        "reason": result.reason,
+        "url": result.url,
+        "headers": dict(result.headers),
+        "encoding": result.encoding,
+        "content": base64.b64encode(result.content).decode("ascii"),
+    }
+
+
+def load_shared_result(data):
+    if "deployment" in data:
+        return DeploymentResponse(*data["deployment"])
+    response = requests.Response()
+    response.status_code = data["status_code"]
+    response.reason = data["reason"]
+    response.url = data["url"]
+    response.headers = CaseInsensitiveDict(data["headers"])
+    response.encoding = data["encoding"]
+    response._content = base64.b64decode(data["content"])
+    return response
+
+
+if SINGLE_FLIGHT == "host":
+    single_flight = HostSingleFlight(SINGLE_FLIGHT_DIR, SINGLE_FLIGHT_MAX_AGE)
+else:
+    single_flight = SingleFlight()
+
+# Shared by all views, and all the requests being handled, for fanning out
+# upstream requests. Only the request thread submits work to it and waits
+# on it, so tasks never block on other tasks in the same pool.
+executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS)
+# For jobs that themselves submit work to the executor above and wait on it.
+# The same goes for these: nothing that runs in it may wait on other jobs in
+# it, or once they're all waiting, nothing is left to run what they wait on.
+coordinator = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS)
+
+
+def after_fork_in_child():
+    """A forked worker gets its own upstream connections, database
+    connections and thread pools. The parent's sockets would be shared with
+    it and the parent's threads don't exist in it."""
+    global executor, coordinator
+    executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS)
+    coordinator = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS)
+    upstream.reset()
+    try:
+        db.engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy < 1.4.33 closes them, which is harmless as long as
+        # the parent never connected. create_app() doesn't.
+        db.engine.dispose()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork_in_child)
+
+
+class Shortlink(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    link = db.Column(db.String(80), unique=True)
+    owner = db.Column(db.String(200))
+    repo = db.Column(db.String(200))
+    revisions = db.Column(db.Text)
+    # See content_hash(). Only NULL for old duplicates.
+    content_hash = db.Column(db.String(64), index=True, unique=True)
+
+    def __init__(self, link, owner, repo, revisions):
+        self.link = link
+        self.owner = owner
+        self.repo = repo
+        assert isinstance(revisions, list), type(revisions)
+        self.revisions = json.dumps(revisions)
+        self.content_hash = content_hash(owner, repo, revisions)
+
+    def __repr__(self):
+        return "<Shortlink %r>" % self.link
+
+
+def content_hash(owner, repo, revisions):
+    """Identify a set of deployments of a repo. 'revisions' is a list of
+    (name, url) like in Shortlink."""
+    return hashlib.sha256(
+        json.dumps([owner, repo, [list(r) for r in revisions]]).encode("utf-8")
+    ).hexdigest()
+
+
+LINK_ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode_link(id_):
+    """Return the shortlink code for a Shortlink id. Unique since ids are.
+    Codes used to be 3 random characters, these are always at least 4, so
+    they can't collide with the old ones either."""
+    number = id_ + len(LINK_ALPHABET) ** 3
+    code = ""
+    while number:
+        number, remainder = divmod(number, len(LINK_ALPHABET))
+        code = LINK_ALPHABET[remainder] + code
+    return code
+
+
+def migrate_shortlinks():
+    """Add and fill in Shortlink.content_hash in databases from before it
+    existed. It's safe to run this any number of times."""
+    table = Shortlink.__table__
+    columns = [c["name"] for c in db.inspect(db.engine).get_columns(table.name)]
+    with db.engine.begin() as connection:
+        if "content_hash" not in columns:
+            connection.execute(
+                db.text("ALTER TABLE shortlink ADD COLUMN content_hash VARCHAR(64)")
+            )
+        seen = set(
+            row[0]
+            for row in connection.execute(
+                db.select([table.c.content_hash]).where(
+                    table.c.content_hash.isnot(None)
+                )
+            )
+        )
+        rows = connection.execute(
+            db.select([table.c.id, table.c.owner, table.c.repo, table.c.revisions])
+            .where(table.c.content_hash.is_(None))
+            .order_by(table.c.id)
+        ).fetchall()
+        filled = 0
+        for id_, owner, repo, revisions in rows:
+            hash_ = content_hash(owner, repo, json.loads(revisions))
+            if hash_ in seen:
+                # A duplicate of an older shortlink. Its link keeps working
+                # but new shortenings will get the older one.
+                continue
+            seen.add(hash_)
+            connection.execute(
+                table.update().where(table.c.id == id_).values(content_hash=hash_)
+            )
+            filled += 1
+        connection.execute(
+            db.text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_shortlink_content_hash "
+                "ON shortlink (content_hash)"
+            )
+        )
+    return filled
+
+
+def migrate_tag_index():
+    """Add TagIndex.etags to databases from before it existed. Returns
+    whether it had to."""
+    table = TagIndex.__table__
+    columns = [c["name"] for c in db.inspect(db.engine).get_columns(table.name)]
+    if "etags" in columns:
+        return False
+    with db.engine.begin() as connection:
+        connection.execute(db.text("ALTER TABLE tag_index ADD COLUMN etags TEXT"))
+    return True
+
+
+@app.cli.command("migrate-shortlinks")
+def migrate_shortlinks_command():
+    """Add and backfill the Shortlink.content_hash column."""
+    print("Backfilled {} shortlinks".format(migrate_shortlinks()))
+
+
+@app.cli.command("migrate-tag-index")
+def migrate_tag_index_command():
+    """Add the TagIndex.etags column."""
+    print("Added TagIndex.etags" if migrate_tag_index() else "Nothing to do")
+
+
+# A Shortlink with 'revisions' already decoded, to a list of [name, url].
+ResolvedShortlink = namedtuple("ResolvedShortlink", "link owner repo revisions")
+
+
+class ShortlinkCache:
+    """LRU of ResolvedShortlink by code. Codes that don't exist aren't
+    remembered, so a new shortlink is found as soon as it's committed."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, link):
+        """Return the ResolvedShortlink for a code, or None."""
+        return self.get_many([link]).get(link)
+
+    def get_many(self, links):
+        """Return a dict of code to ResolvedShortlink for the codes that
+        exist. The ones not in memory are looked up in one query."""
+        found = {}
+        with self.lock:
+            for link in links:
+                resolved = self.entries.get(link)
+                if resolved is not None:
+                    self.entries.move_to_end(link)
+                    found[link] = resolved
+        missing = [link for link in links if link not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            for shortlink in Shortlink.query.filter(Shortlink.link.in_(missing)):
+                resolved = ResolvedShortlink(
+                    shortlink.link,
+                    shortlink.owner,
+                    shortlink.repo,
+                    json.loads(shortlink.revisions),
+                )
+                self.set(resolved)
+                found[resolved.link] = resolved
+        return found
+
+    def set(self, resolved):
+        with self.lock:
+            self.entries[resolved.link] = resolved
+            self.entries.move_to_end(resolved.link)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, link):
+        with self.lock:
+            self.entries.pop(link, None)
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+shortlink_cache = ShortlinkCache(SHORTLINK_CACHE_SIZE)
+
+
+class Snapshot(db.Model):
+    """How often a shortlink is requested and, if the refresher has gotten
+    to it, its precomputed /shas and /culprits responses. 'key' identifies
+    the /shas request (see content_hash()) and 'culprits_key' the /culprits
+    request that follows it."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    link = db.Column(db.String(80), unique=True)
+    key = db.Column(db.String(64), index=True)
+    culprits_key = db.Column(db.String(64), index=True)
+    hits = db.Column(db.Integer, default=0)
+    last_hit = db.Column(db.Float)
+    shas = db.Column(db.Text)
+    culprits = db.Column(db.Text)
+    refreshed = db.Column(db.Float)
+
+    def __repr__(self):
+        return "<Snapshot %r>" % self.link
+
+
+def culprits_snapshot_key(owner, repo, deployments):
+    return content_hash(owner, repo, [(d["name"], d["sha"]) for d in deployments])
+
+
+def record_hit(shortlink):
+    """Count a request for a shortlink (a ResolvedShortlink), so the
+    refresher knows which ones are worth keeping snapshots of."""
+    table = Snapshot.__table__
+    with db.engine.begin() as connection:
+        updated = connection.execute(
+            table.update()
+            .where(table.c.link == shortlink.link)
+            .values(hits=table.c.hits + 1, last_hit=time.time())
+        ).rowcount
+        if not updated:
+            try:
+                connection.execute(
+                    table.insert().values(
+                        link=shortlink.link,
+                        key=content_hash(
+                            shortlink.owner, shortlink.repo, shortlink.revisions
+                        ),
+                        hits=1,
+                        last_hit=time.time(),
+                    )
+                )
+            except IntegrityError:
+                pass
+
+
+def get_snapshot(column, key, value_column):
+    """Return the decoded JSON of a fresh enough snapshot, or None."""
+    table = Snapshot.__table__
+    with db.engine.begin() as connection:
+        row = connection.execute(
+            db.select([value_column, table.c.refreshed])
+            .where(column == key)
+            .where(value_column.isnot(None))
+            .where(table.c.refreshed > time.time() - SNAPSHOT_MAX_AGE)
+            .limit(1)
+        ).first()
+    if row is not None:
+        return json.loads(row[0])
+
+
+class ShaResult(db.Model):
+    """Anything derived from a specific git sha, like a commit's payload or
+    its culprits, which means it can be kept forever."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(300), unique=True)
+    value = db.Column(db.Text)
+    size = db.Column(db.Integer)
+    last_used = db.Column(db.Float, index=True)
+
+    def __repr__(self):
+        return "<ShaResult %r>" % self.key
+
+
+def evict_least_recently_used(connection, table, max_bytes):
+    """Delete the least recently used rows of a table with 'size' and
+    'last_used' columns until the sizes sum up to no more than max_bytes."""
+    total = connection.execute(
+        db.select([db.func.coalesce(db.func.sum(table.c.size), 0)])
+    ).scalar()
+    excess = total - max_bytes
+    if excess <= 0:
+        return
+    ids = []
+    for id_, size in connection.execute(
+        db.select([table.c.id, table.c.size]).order_by(table.c.last_used)
+    ):
+        ids.append(id_)
+        excess -= size
+        if excess <= 0:
+            break
+    connection.execute(table.delete().where(table.c.id.in_(ids)))
+
+
+class PermanentCache:
+    """JSON values in the ShaResult table. There's no expiry, only eviction
+    when the table grows past max_bytes. Keys are stored lowercase since
+    GitHub ignores the case of the owner and repo names in them."""
+
+    # Seconds before a hit updates the row's last_used again. Eviction only
+    # needs a rough order, and this way most hits are just the one SELECT.
+    TOUCH_INTERVAL = 60 * 60
+    # Seconds between adding up the sizes of all the rows to see if any
+    # need evicting. In between, the table can grow past max_bytes by what
+    # gets set.
+    EVICT_INTERVAL = 60
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.table = ShaResult.__table__
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, key):
+        table = self.table
+        key = key.lower()
+        with db.engine.begin() as connection:
+            row = connection.execute(
+                db.select([table.c.value, table.c.last_used]).where(table.c.key == key)
+            ).first()
+            if row is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - (row.last_used or 0) >= self.TOUCH_INTERVAL:
+                connection.execute(
+                    table.update().where(table.c.key == key).values(last_used=now)
+                )
+        self.hits += 1
+        return json.loads(row.value)
+
+    def set(self, key, value):
+        table = self.table
+        key = key.lower()
+        value = json.dumps(value)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.key == key))
+                connection.execute(
+                    table.insert().values(
+                        key=key, value=value, size=len(value), last_used=time.time()
+                    )
+                )
+        except IntegrityError:
+            # Someone else set it at the same time. Theirs is just as good.
+            return
+        now = time.time()
+        if now - self.evicted >= self.EVICT_INTERVAL:
+            self.evicted = now
+            with db.engine.begin() as connection:
+                evict_least_recently_used(connection, table, self.max_bytes)
+
+    def delete(self, key):
+        table = self.table
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.key == key.lower()))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+permanent_cache = PermanentCache(PERMANENT_CACHE_MAX_BYTES)
+
+
+class TagIndex(db.Model):
+    """All the tags of a repo, as a JSON list of [name, sha] in GitHub's
+    order (by name), and a JSON list of the ETags of their pages. As long
+    as those don't change, neither have the tags. 'complete' is false if
+    the last fetch of all the tags was cut short."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner = db.Column(db.String(200))
+    repo = db.Column(db.String(200))
+    tags = db.Column(db.Text)
+    complete = db.Column(db.Boolean)
+    etags = db.Column(db.Text)
+    refreshed = db.Column(db.Float)
+    __table_args__ = (db.UniqueConstraint("owner", "repo"),)
+
+    def __repr__(self):
+        return "<TagIndex %s/%s>" % (self.owner, self.repo)
+
+
+class CachedResponse(db.Model):
+    """GitHub API responses for the "database" GITHUB_CACHE_BACKEND."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True)
+    url = db.Column(db.Text)
+    etag = db.Column(db.String(200))
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    size = db.Column(db.Integer)
+    last_used = db.Column(db.Float, index=True)
+
+
+CacheEntry = namedtuple("CacheEntry", "url etag headers body")
+
+
+class MemoryCacheBackend:
+    """LRU of CacheEntry objects, bounded by the total size of the bodies."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self._delete(key)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+
+    def delete_prefix(self, prefix):
+        """Delete every entry whose URL starts with 'prefix', ignoring case.
+        Returns how many there were."""
+        prefix = prefix.lower()
+        with self.lock:
+            keys = [
+                k for k, v in self.entries.items() if v.url.lower().startswith(prefix)
+            ]
+            for key in keys:
+                self._delete(key)
+        return len(keys)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DatabaseCacheBackend:
+    """LRU of CacheEntry objects stored in the CachedResponse table.
+
+    Uses its own short transactions (not db.session) so it's safe to use
+    from the executor threads."""
+
+    # Both the same as PermanentCache's.
+    TOUCH_INTERVAL = PermanentCache.TOUCH_INTERVAL
+    EVICT_INTERVAL = PermanentCache.EVICT_INTERVAL
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.table = CachedResponse.__table__
+        self.evicted = 0
+
+    def get(self, key):
+        table = self.table
+        with db.engine.begin() as connection:
+            row = connection.execute(table.select().where(table.c.key == key)).first()
+            if row is None:
+                return None
+            now = time.time()
+            if now - (row.last_used or 0) >= self.TOUCH_INTERVAL:
+                connection.execute(
+                    table.update().where(table.c.key == key).values(last_used=now)
+                )
+        return CacheEntry(row.url, row.etag, json.loads(row.headers), row.body)
+
+    def set(self, key, entry):
+        table = self.table
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.key == key))
+                connection.execute(
+                    table.insert().values(
+                        key=key,
+                        url=entry.url,
+                        etag=entry.etag,
+                        headers=json.dumps(entry.headers),
+                        body=entry.body,
+                        size=len(entry.body),
+                        last_used=time.time(),
+                    )
+                )
+        except IntegrityError:
+            # Another process got the same response at the same time.
+            return
+        now = time.time()
+        if now - self.evicted >= self.EVICT_INTERVAL:
+            self.evicted = now
+            with db.engine.begin() as connection:
+                evict_least_recently_used(connection, table, self.max_bytes)
+
+    def delete(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.key == key))
+
+    def delete_prefix(self, prefix):
+        table = self.table
+        with db.engine.begin() as connection:
+            return connection.execute(
+                table.delete().where(
+                    db.func.lower(table.c.url).startswith(
+                        prefix.lower(), autoescape=True
+                    )
+                )
+            ).rowcount
+
+    def __len__(self):
+        with db.engine.begin() as connection:
+            return connection.execute(
+                db.select([db.func.count()]).select_from(self.table)
+            ).scalar()
+
+
+class ConditionalRequestCache:
+    """Remembers GitHub responses by URL and auth identity together with
+    their ETag. Subsequent requests send If-None-Match and if GitHub says
+    304 Not Modified (which doesn't count against the rate limit) the
+    stored body is used instead."""
+
+    # Response headers worth keeping. "Link" is needed for pagination.
+    KEEP_HEADERS = ("Content-Type", "ETag", "Link")
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(url, identity):
+        return hashlib.sha256((identity + "\n" + url).encode("utf-8")).hexdigest()
+
+    def get(self, url, headers, identity, **kwargs):
+        key, entry, headers = self.prepare(url, headers, identity)
+        response = upstream.get(url, headers=headers, **kwargs)
+        return self.finish(key, entry, url, response)
+
+    def prepare(self, url, headers, identity):
+        """Return the key, the stored entry (or None) and the headers to
+        request the URL with."""
+        key = self.make_key(url, identity)
+        entry = self.backend.get(key)
+        if entry is not None:
+            headers = dict(headers, **{"If-None-Match": entry.etag})
+        return key, entry, headers
+
+    def finish(self, key, entry, url, response):
+        """Return the response to use given the one GitHub sent, storing it
+        if it's new."""
+        if response.status_code == 304 and entry is not None:
+            self.hits += 1
+            cached = self.make_response(entry)
+            # The rate limit headers are about now, not the cached response.
+            for k, v in response.headers.items():
+                if k.lower().startswith("x-ratelimit-"):
+                    cached.headers[k] = v
+            return cached
+        self.misses += 1
+        if response.status_code == 200 and response.headers.get("ETag"):
+            self.backend.set(key, self.make_entry(url, response))
+        return response
+
+    def forget(self, prefix):
+        """Drop the stored responses of every URL that starts with 'prefix'
+        so they aren't kept around once they're known to be outdated."""
+        return self.backend.delete_prefix(prefix)
+
+    def make_entry(self, url, response):
+        return CacheEntry(
+            url,
+            response.headers["ETag"],
+            {
+                k: response.headers[k]
+                for k in self.KEEP_HEADERS
+                if k in response.headers
+            },
+            response.content,
+        )
+
+    @staticmethod
+    def make_response(entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry.url
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response._content = entry.body
+        response.encoding = "utf-8"
+        return response
+
+    def stats(self):
+        return {
+            "backend": GITHUB_CACHE_BACKEND,
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+if GITHUB_CACHE_BACKEND == "memory":
+    github_cache = ConditionalRequestCache(MemoryCacheBackend(GITHUB_CACHE_MAX_BYTES))
+elif GITHUB_CACHE_BACKEND == "database":
+    github_cache = ConditionalRequestCache(DatabaseCacheBackend(GITHUB_CACHE_MAX_BYTES))
+else:
+    github_cache = None
+
+
+class RateLimitExhausted(UpstreamError):
+    def __init__(self, retry_after):
+        super().__init__(
+            "GitHub rate limit exhausted. Try again in {} seconds.".format(
+                int(retry_after)
+            )
+        )
+        self.retry_after = retry_after
+
+
+class TokenPool:
+    """Keeps track of how much rate limit each GitHub token has left, per
+    resource ("core", "graphql", ...), going by the X-RateLimit-* headers
+    of the responses. With no tokens it tracks the anonymous limit."""
+
+    def __init__(self, tokens, max_wait):
+        self.tokens = tokens or [None]
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        # (token, resource) -> {"remaining": int, "limit": int, "reset": epoch}
+        self.budgets = {}
+        self.exhausted = 0
+        # What the ConditionalRequestCache keys on. All tokens see the same.
+        self.identity = hashlib.sha256(
+            "\n".join(t or "" for t in self.tokens).encode("utf-8")
+        ).hexdigest()
+
+    def acquire(self, resource="core"):
+        """Return the token with the most calls left. If they're all out,
+        wait (up to max_wait) for the first one to be reset or raise
+        RateLimitExhausted."""
+        while True:
+            with self.lock:
+                now = time.time()
+                best = None
+                best_remaining = -1
+                first_reset = None
+                for token in self.tokens:
+                    budget = self.budgets.get((token, resource))
+                    if budget is None or budget["reset"] <= now:
+                        # Never used or since reset, so presumably plenty.
+                        remaining = float("inf")
+                    else:
+                        remaining = budget["remaining"]
+                        if not remaining and (
+                            first_reset is None or budget["reset"] < first_reset
+                        ):
+                            first_reset = budget["reset"]
+                    if remaining > best_remaining:
+                        best, best_remaining = token, remaining
+                if best_remaining > 0:
+                    budget = self.budgets.get((best, resource))
+                    if budget is not None and budget["reset"] > now:
+                        # Count it now so concurrent calls spread out.
+                        budget["remaining"] -= 1
+                    return best
+            wait_for = first_reset - now
+            if wait_for > self.max_wait:
+                self.exhausted += 1
+                raise RateLimitExhausted(wait_for)
+            time.sleep(max(wait_for, 0.1))
+
+    def update(self, token, response):
+        headers = response.headers
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        try:
+            budget = {
+                "remaining": int(headers["X-RateLimit-Remaining"]),
+                "limit": int(headers.get("X-RateLimit-Limit", 0)),
+                "reset": float(headers["X-RateLimit-Reset"]),
+            }
+        except (KeyError, ValueError):
+            return
+        resource = headers.get("X-RateLimit-Resource", "core")
+        with self.lock:
+            self.budgets[(token, resource)] = budget
+
+    @staticmethod
+    def headers(token):
+        headers = dict(GITHUB_REQUEST_HEADERS)
+        if token:
+            headers["Authorization"] = "token {}".format(token)
+        return headers
+
+    def stats(self):
+        now = time.time()
+        tokens = []
+        with self.lock:
+            for (token, resource), budget in sorted(
+                self.budgets.items(), key=lambda item: (item[0][0] or "", item[0][1])
+            ):
+                tokens.append(
+                    {
+                        # Never show the whole token.
+                        "token": "..." + token[-4:] if token else "anonymous",
+                        "resource": resource,
+                        "remaining": budget["remaining"],
+                        "limit": budget["limit"],
+                        "reset_in": max(0, int(budget["reset"] - now)),
+                    }
+                )
+        return {"tokens": tokens, "exhausted": self.exhausted}
+
+
+token_pool = TokenPool(GITHUB_AUTH_TOKENS, GITHUB_RATE_LIMIT_MAX_WAIT)
+
+
+def github_get(url, **kwargs):
+    """GET something from the GitHub API, revalidating with ETags if we've
+    seen the URL before. If the same URL is already being fetched, wait for
+    that instead."""
+    if SINGLE_FLIGHT == "off":
+        return _github_get(url, **kwargs)
+    return single_flight.do(("github", url), _github_get, url, **kwargs)
+
+
+def _github_get(url, **kwargs):
+    # If a token turns out to be out of calls, try (at most) each of the
+    # others.
+    for _ in token_pool.tokens:
+        token = token_pool.acquire()
+        headers = token_pool.headers(token)
+        if github_cache is None:
+            response = github_breaker.call(
+                "GitHub", upstream.get, url, headers=headers, **kwargs
+            )
+        else:
+            response = github_breaker.call(
+                "GitHub",
+                github_cache.get,
+                url,
+                headers,
+                identity=token_pool.identity,
+                **kwargs,
+            )
+        token_pool.update(token, response)
+        if not is_rate_limited(response):
+            break
+    return response
+
+
+# Whatever involves more than one call to GitHub is written as generators
+# of "steps" that yield what they need and are sent back the result. That
+# way the same code runs both here, with threads (see run_steps()), and in
+# asgi.py with coroutines. A step is one of:
+
+# github_get() each URL. What's sent back is a list, in the same order, of
+# the responses or of the exceptions raised instead (see checked()).
+GitHubGets = namedtuple("GitHubGets", "urls")
+# function(*args), e.g. something with the database.
+BlockingCall = namedtuple("BlockingCall", "function args")
+
+
+def run_steps(steps):
+    """Run a generator of steps to the end and return what it returns. Its
+    GitHubGets are fetched in parallel on the executor."""
+    value = None
+    while True:
+        try:
+            step = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, GitHubGets):
+            value = github_get_all(step.urls)
+        else:
+            value = step.function(*step.args)
+
+
+def github_get_all(urls):
+    if len(urls) == 1:
+        try:
+            return [github_get(urls[0])]
+        except Exception as exception:
+            return [exception]
+    futures = [submit(executor, github_get, url) for url in urls]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as exception:
+            results.append(exception)
+    return results
+
+
+def checked(result):
+    """A response a GitHubGets step was sent back, unless it failed, in
+    which case it raises whatever was raised or requests' HTTPError."""
+    if isinstance(result, Exception):
+        raise result
+    result.raise_for_status()
+    return result
+
+
+def is_rate_limited(response):
+    return (
+        response.status_code in (403, 429)
+        and response.headers.get("X-RateLimit-Remaining") == "0"
+    )
+
+
+def extract_sha(content):
+    content = content.strip()
+
+    if content.startswith("{") and content.endswith("}"):
+        # If it starts and ends with curly braces, it just might be a json
+        # object
+        try:
+            data = json.loads(content)
+
+            # This is where it's at in Dockerflow-supported sites
+            if "commit" in data:
+                return data["commit"]
+
+        except json.decoder.JSONDecodeError:
+            pass
+
+    if 7 <= len(content) <= 40:
+        return content
+
+
+class ShaReader:
+    """Reads the body of a deployment URL a chunk at a time and stops as
+    soon as it has found the sha, or can tell it isn't going to. Timeouts
+    only apply to each read, so if 'expires' (a time.monotonic()) passes
+    before it's done it raises ReadTimeout, however fast each chunk came."""
+
+    # The "commit" of a Dockerflow version.json.
+    DOCKERFLOW_COMMIT = re.compile(r'"commit"\s*:\s*"([0-9a-fA-F]{7,40})"')
+
+    def __init__(self, max_bytes, encoding=None, expires=None):
+        self.max_bytes = max_bytes
+        self.encoding = encoding or "utf-8"
+        self.expires = expires
+        self.body = b""
+        self.sha = None
+        self.rejected = False
+
+    @property
+    def content(self):
+        return self.body.decode(self.encoding, "replace").strip()
+
+    def feed(self, chunk):
+        """Add the next chunk of the body. Returns true if there's no point
+        reading any more of it."""
+        if self.expires is not None and time.monotonic() > self.expires:
+            raise ReadTimeout("Ran out of time reading the body")
+        self.body += chunk
+        content = self.content
+        if content.startswith("{"):
+            for match in self.DOCKERFLOW_COMMIT.finditer(content):
+                # Not some nested object's "commit".
+                if self.is_top_level(content[: match.start()]):
+                    self.sha = match.group(1)
+                    return True
+        elif content.startswith("<") or len(content) > 40:
+            # HTML, or too long to be a sha.
+            self.rejected = True
+            return True
+        if len(self.body) >= self.max_bytes:
+            self.rejected = True
+            return True
+        return False
+
+    @staticmethod
+    def is_top_level(before):
+        """Whether what follows the start of a JSON object 'before' is
+        directly in that object, i.e. not in a nested one or a string."""
+        depth = 0
+        in_string = escaped = False
+        for character in before:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif character == "\\":
+                    escaped = True
+                elif character == '"':
+                    in_string = False
+            elif character == '"':
+                in_string = True
+            elif character in "{[":
+                depth += 1
+            elif character in "}]":
+                depth -= 1
+        return depth == 1 and not in_string
+
+    def result(self):
+        """Return the sha, or None if the body didn't have one."""
+        if self.sha is None and not self.rejected:
+            # All of it was read, so maybe it's JSON the regex didn't get.
+            self.sha = extract_sha(self.content)
+        return self.sha
+
+
+# What a deployment URL responded. 'content' is what was read of the body.
+DeploymentResponse = namedtuple("DeploymentResponse", "status_code content sha")
+
+
+def page_urls(last_url):
+    """Return the URLs for page 2 up to and including the page that the
+    'last' URL (from a GitHub Link header) points to."""
+    parsed = urlparse(last_url)
+    query = parse_qs(parsed.query)
+    last_page = int(query["page"][0])
+    for page in range(2, last_page + 1):
+        query["page"] = [str(page)]
+        yield parsed._replace(query=urlencode(query, True)).geturl()
+
+
+def all_tags_steps(tags_url):
+    """Steps (see run_steps()) returning a list of (name, sha) of every
+    tag, the ETags of the pages they were on, and whether that's really all
+    of them (it's not if a page timed out). Raises if the first page can't
+    be had."""
+    (first,) = yield GitHubGets([tags_url])
+    pages = [checked(first)]
+    complete = True
+    if "last" in first.links:
+        # We know how many pages there are, so fetch all the rest at once.
+        rest = yield GitHubGets(list(page_urls(first.links["last"]["url"])))
+        try:
+            pages.extend(checked(r) for r in rest)
+        except (UpstreamError, requests.exceptions.RequestException):
+            # Like before, a timeout means we make do with what we have.
+            complete = False
+    tags = []
+    for r in pages:
+        for tag in r.json():
+            tags.append((tag["name"], tag["commit"]["sha"]))
+    return tags, [r.headers.get("ETag") for r in pages], complete
+
+
+def tags_steps(owner, repo):
+    """Steps returning a dict of sha to tag name for a repo from the stored
+    tag index, bringing it up to date with GitHub first.
+
+    GitHub lists tags by name, not by when they were created, so a new tag
+    can be on any page (e.g. a backport) and all of them are fetched every
+    time. Thanks to the conditional request cache those are usually 304s
+    (which don't count against the rate limit), and if none of the ETags
+    changed there's nothing to store either."""
+    row, tags, complete = yield BlockingCall(read_tag_index, (owner, repo))
+
+    if not row or time.time() - row.refreshed >= TAG_INDEX_MAX_AGE:
+        try:
+            fetched, etags, fetched_complete = yield from all_tags_steps(
+                make_tags_url(owner, repo)
+            )
+        except (UpstreamError, requests.exceptions.RequestException):
+            # Make do with what's stored, and try again next time.
+            pass
+        else:
+            if fetched_complete:
+                # Everything, so deleted tags are gone too.
+                etags = json.dumps(etags)
+                changed = not (complete and row and etags == row.etags)
+                tags = fetched
+            else:
+                etags = None
+                changed = True
+                tags = merge_tags(fetched, tags)
+            yield BlockingCall(
+                write_tag_index,
+                (owner, repo, row, tags, fetched_complete, etags, changed),
+            )
+
+    by_sha = {}
+    for name, sha in tags:
+        by_sha[sha] = name
+    return by_sha
+
+
+def get_tags(owner, repo):
+    return run_steps(tags_steps(owner, repo))
+
+
+def make_tags_url(owner, repo):
+    return GITHUB_API_URL + ("/repos/{owner}/{repo}/tags?per_page=100").format(
+        owner=owner, repo=repo
+    )
+
+
+def read_tag_index(owner, repo):
+    """Return the TagIndex row (or None), its tags and whether they're
+    complete."""
+    table = TagIndex.__table__
+    where = (table.c.owner == owner) & (table.c.repo == repo)
+    with db.engine.begin() as connection:
+        row = connection.execute(table.select().where(where)).first()
+    tags = json.loads(row.tags) if row else []
+    complete = bool(row and row.complete)
+    return row, tags, complete
+
+
+def merge_tags(new, tags):
+    """Put the newly found tags before the known ones, replacing any known
+    ones by the same name. For when not all of them could be fetched."""
+    names = set(name for name, _ in new)
+    return [list(tag) for tag in new] + [tag for tag in tags if tag[0] not in names]
+
+
+def write_tag_index(owner, repo, row, tags, complete, etags, changed):
+    table = TagIndex.__table__
+    where = (table.c.owner == owner) & (table.c.repo == repo)
+    values = {"refreshed": time.time()}
+    if changed:
+        # Otherwise it's only the time it was checked that's new.
+        values.update(tags=json.dumps(tags), complete=complete, etags=etags)
+    with db.engine.begin() as connection:
+        if row:
+            connection.execute(table.update().where(where).values(**values))
+        else:
+            try:
+                connection.execute(
+                    table.insert().values(owner=owner, repo=repo, **values)
+                )
+            except IntegrityError:
+                # Someone else got there first. Theirs is just as good.
+                pass
+
+
+def fetch_content(url):
+    if SINGLE_FLIGHT == "off":
+        return _fetch_content(url)
+    return single_flight.do(("deployment", url), _fetch_content, url)
+
+
+def _fetch_content(url):
+    """Return a DeploymentResponse. Only as much of the body as is needed
+    to find the sha is downloaded, and never more than DEPLOYMENT_MAX_BYTES."""
+    timeout = upstream_timeout()
+    expires = time.monotonic() + timeout
+    response = upstream.get(
+        scramble(url),
+        # Uncompressed, so iter_arriving() can give ShaReader the bytes as is.
+        headers=dict(GITHUB_REQUEST_HEADERS, **{"Accept-Encoding": "identity"}),
+        stream=True,
+        timeout=timeout,
+    )
+    try:
+        reader = ShaReader(DEPLOYMENT_MAX_BYTES, response.encoding, expires)
+        if response.status_code == 200:
+            for chunk in iter_arriving(response, 4096):
+                if reader.feed(chunk):
+                    break
+        return DeploymentResponse(response.status_code, reader.content, reader.result())
+    finally:
+        response.close()
+
+
+def iter_arriving(response, size):
+    """Yield the body of a streamed response in pieces of up to 'size' bytes
+    as soon as they arrive. iter_content() waits until it has all 'size'
+    bytes, so with a body trickling in it can be a long time between pieces,
+    and the timeout only applies to each read from the socket. urllib3 1.x
+    has no way to get what's arrived so far, but http.client does."""
+    fp = getattr(response.raw, "_fp", None)
+    encoding = response.headers.get("Content-Encoding", "identity")
+    if encoding != "identity" or not hasattr(fp, "read1"):
+        # It's up to urllib3 to decode it.
+        yield from response.iter_content(size)
+        return
+    while True:
+        try:
+            chunk = fp.read1(size)
+        except socket.timeout as exception:
+            raise ReadTimeout(str(exception))
+        except (OSError, http.client.HTTPException) as exception:
+            raise requests.exceptions.ConnectionError(str(exception))
+        if not chunk:
+            return
+        yield chunk
+
+
+def scramble(url):
+    """Make sure no cache between us and the deployment answers."""
+    if "?" in url:
+        url += "&"
+    else:
+        url += "?"
+    url += "cachescramble=%s" % time.time()
+    return url
+
+
+class DeploymentCache:
+    """Deployment URL to sha, for a few seconds. After 'ttl' seconds, and
+    for 'grace' seconds more, the old sha is still returned but one
+    refresh is started in the background."""
+
+    # Beyond this many URLs, expired ones are thrown out.
+    MAX_ENTRIES = 1000
+
+    def __init__(self, ttl, grace):
+        self.ttl = ttl
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.refreshing = set()
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+    def get(self, url, fetch):
+        sha = self.lookup(url, fetch)
+        if sha is None:
+            sha = self.refresh(url, fetch)
+        return sha
+
+    def lookup(self, url, fetch):
+        """Return the remembered sha, or None if there isn't one (anymore)."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is not None:
+            sha, fetched = entry
+            age = time.time() - fetched
+            if age < self.ttl:
+                self.hits += 1
+                return sha
+            if age < self.ttl + self.grace:
+                self.stale += 1
+                with self.lock:
+                    refresh = url not in self.refreshing
+                    self.refreshing.add(url)
+                if refresh:
+                    submit(executor, self.refresh, url, fetch)
+                return sha
+        self.misses += 1
+        return None
+
+    def refresh(self, url, fetch):
+        try:
+            sha = fetch(url)
+        except UpstreamError:
+            # Don't keep serving the old sha for something that's broken.
+            self.forget(url)
+            raise
+        else:
+            self.set(url, sha)
+            return sha
+        finally:
+            with self.lock:
+                self.refreshing.discard(url)
+
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def set(self, url, sha):
+        with self.lock:
+            self.entries[url] = (sha, time.time())
+            if len(self.entries) > self.MAX_ENTRIES:
+                too_old = time.time() - self.ttl - self.grace
+                for key, (_, fetched) in list(self.entries.items()):
+                    if fetched < too_old:
+                        del self.entries[key]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "stale": self.stale,
+            "misses": self.misses,
+        }
+
+
+deployment_cache = DeploymentCache(DEPLOYMENT_CACHE_TTL, DEPLOYMENT_CACHE_GRACE)
+
+
+def deployment_sha(url, force=False):
+    """Return the sha that a deployment URL says is deployed. Raises
+    UpstreamError if it can't be loaded or doesn't look like a sha.
+    Unless 'force' is true it might come from the DeploymentCache."""
+    if not DEPLOYMENT_CACHE_TTL:
+        return _deployment_sha(url)
+    if force:
+        sha = _deployment_sha(url)
+        deployment_cache.set(url, sha)
+        return sha
+    return deployment_cache.get(url, _deployment_sha)
+
+
+def _deployment_sha(url):
+    try:
+        response = deployment_breaker.call(url, fetch_content, url)
+    except ReadTimeout:
+        raise UpstreamError("Timeout error trying to load {}".format(url))
+    except requests.exceptions.ConnectionError:
+        raise UpstreamError("Unable to connect to {}".format(url))
+    except requests.exceptions.RequestException:
+        # E.g. not even a valid URL.
+        raise UpstreamError("Unable to load {}".format(url))
+    return sha_from_response(url, response)
+
+
+def sha_from_response(url, response):
+    if response.status_code != 200:
+        raise UpstreamError("{} trying to load {}".format(response.status_code, url))
+    if not response.sha:
+        # doesn't appear to be a git sha
+        raise UpstreamError(
+            "Doesn't look like a sha\n (%s) on %s" % (response.content, url)
+        )
+    return response.sha
+
+
+def filter_tags(tags, environment, deployments):
+    """If the client only wants to know about the tags of some shas
+    ("tags_for"), only keep those and the ones of the deployed shas."""
+    if "tags_for" not in environment:
+        return tags
+    wanted = set(environment["tags_for"])
+    wanted.update(deployment["sha"] for deployment in deployments)
+    return {sha: name for sha, name in tags.items() if sha in wanted}
+
+
+def compute_shas(owner, repo, revisions, force=False):
+    """Return what /shas responds with for a list of (name, url). Raises
+    UpstreamError if any of the deployment shas can't be had. With 'force'
+    every deployment URL is fetched, not taken from the DeploymentCache."""
+    deployments = []
+    # Skip empty urls
+    to_fetch = [(name, url) for name, url in revisions if url]
+    # Start fetching all the deployment shas and, in the meantime, the tags.
+    futures = [submit(executor, deployment_sha, url, force) for _, url in to_fetch]
+    tags = get_tags(owner, repo)
+    for (name, url), future in zip(to_fetch, futures):
+        # Fetch the sha and balk if it doesn't exist
+        deployments.append(
+            {"name": name, "sha": future.result(), "bugs": [], "url": url}
+        )
+    return {"deployments": deployments, "tags": tags}
+
+
+class ShasView(MethodView):
+    def post(self):
+        environment = request.json
+        owner = environment["owner"]
+        repo = environment["repo"]
+        revisions = [(each["name"], each["url"]) for each in environment["deployments"]]
+        # The client can insist on getting the very latest.
+        force = bool(environment.get("refresh"))
+
+        result = None
+        if SNAPSHOTS and not force:
+            result = get_snapshot(
+                Snapshot.key,
+                content_hash(owner, repo, revisions),
+                Snapshot.shas,
+            )
+        if result is None:
+            try:
+                with deadline(REQUEST_DEADLINE):
+                    result = compute_shas(owner, repo, revisions, force)
+            except UpstreamError as exception:
+                return make_response(jsonify({"error": str(exception)}))
+
+        result["tags"] = filter_tags(result["tags"], environment, result["deployments"])
+        response = make_response(jsonify(result))
+        return response
+
+
+class ShasStreamView(MethodView):
+    """Like ShasView but the response is newline delimited JSON. There's one
+    record for each deployment as soon as its sha is known (or it failed),
+    then one with all the tags and lastly a summary."""
+
+    def post(self):
+        environment = request.json
+        to_fetch = [each for each in environment["deployments"] if each["url"]]
+        force = bool(environment.get("refresh"))
+        with deadline(REQUEST_DEADLINE):
+            futures = {
+                submit(executor, deployment_sha, each["url"], force): each
+                for each in to_fetch
+            }
+            tags_future = submit(
+                coordinator, get_tags, environment["owner"], environment["repo"]
+            )
+
+        def generate():
+            t0 = time.time()
+            deployments = []
+            errors = 0
+            for future in as_completed(futures):
+                each = futures[future]
+                try:
+                    deployment = {
+                        "name": each["name"],
+                        "sha": future.result(),
+                        "bugs": [],
+                        "url": each["url"],
+                    }
+                except (
+                    UpstreamError,
+                    requests.exceptions.RequestException,
+                ) as exception:
+                    errors += 1
+                    yield ndjson_record(
+                        "error",
+                        name=each["name"],
+                        url=each["url"],
+                        error=str(exception),
+                    )
+                else:
+                    deployments.append(deployment)
+                    yield ndjson_record("deployment", deployment=deployment)
+            tags = filter_tags(tags_future.result(), environment, deployments)
+            yield ndjson_record("tags", tags=tags)
+            yield ndjson_record(
+                "summary",
+                deployments=len(deployments),
+                errors=errors,
+                took=time.time() - t0,
+            )
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+
+def ndjson_record(type_, **data):
+    return json.dumps(dict({"type": type_}, **data)) + "\n"
+
+
+def culprits_group(pr, comments, commit):
+    """Work out who's responsible for a sha given the pull request that was
+    merged as it (if any), the comments on that pull request and the commit
+    itself."""
+    users = []
+    links = []
+    if pr is not None:
+        links.append(pr["_links"]["html"]["href"])
+        author = pr["user"]
+        users.append(("Author", author))
+        committer = pr.get("committer")
+        if committer and committer != author:
+            users.append(("Committer", committer))
+        # let's also dig into what other people participated
+        for assignee in pr["assignees"]:
+            users.append(("Assignee", assignee))
+        # Other people who commented on the PR
+        for comment in comments:
+            try:
+                user = comment["user"]
+                users.append(("Commenter", user))
+            except TypeError:
+                print("COMMENT")
+                print(comment)
+
+    author = commit["author"]
+    if ("Author", author) not in users:
+        users.append(("Author", author))
+    committer = commit.get("committer")
+    if committer:
+        if committer["login"] == "web-flow":
+            # Then the author pressed the green button and let
+            # GitHub merge it.
+            # Change the label of the author to also be the committer
+            users.append(("Committer", author))
+        elif committer != author:
+            users.append(("Committer", committer))
+    # Deleted accounts, and commits by emails that aren't on GitHub, have
+    # no user.
+    users = [(label, user) for label, user in users if user]
+    # Now merge the labels for user
+    labels = defaultdict(list)
+    for label, user in users:
+        if label not in labels[user["login"]]:
+            labels[user["login"]].append(label)
+    labels_map = {}
+    for login, labels in labels.items():
+        labels_map[login] = " & ".join(labels)
+    unique_users = []
+    _logins = set()
+    for _, user in users:
+        if user["login"] not in _logins:
+            _logins.add(user["login"])
+            unique_users.append((labels_map[user["login"]], user))
+    return {"users": unique_users, "links": links}
+
+
+CULPRITS_GRAPHQL_FRAGMENT = """
+fragment actor on Actor { login avatarUrl url }
+fragment culprits on Commit {
+  author { user { ...actor } }
+  committer { user { ...actor } }
+  associatedPullRequests(first: 5) {
+    nodes {
+      url
+      mergeCommit { oid }
+      author { ...actor }
+      assignees(first: 10) { nodes { ...actor } }
+      comments(first: 100) { nodes { author { ...actor } } }
+    }
+  }
+}
+"""
+
+
+class GraphQLError(Exception):
+    """When the GraphQL API answers but with errors instead of data."""
+
+
+def graphql_culprits(owner, repo, shas):
+    """Return a dict of sha to culprits group, the same as culprits_group()
+    makes from REST calls, but for all the shas in one GraphQL query."""
+    token = token_pool.acquire("graphql")
+    r = github_breaker.call(
+        "GitHub",
+        upstream.post,
+        GITHUB_GRAPHQL_URL,
+        headers=token_pool.headers(token),
+        json=culprits_graphql_query(owner, repo, shas),
+    )
+    token_pool.update(token, r)
+    r.raise_for_status()
+    return culprits_from_graphql(owner, repo, shas, r.json())
+
+
+def culprits_graphql_query(owner, repo, shas):
+    variables = {"owner": owner, "repo": repo}
+    objects = []
+    for i, sha in enumerate(shas):
+        variables["sha{}".format(i)] = sha
+        # An expression rather than an oid since deployments often only
+        # say what the sha starts with, which isn't a GitObjectID.
+        objects.append(
+            "sha{0}: object(expression: $sha{0}) {{ ...culprits }}".format(i)
+        )
+    query = (
+        "query($owner: String!, $repo: String!, {}) {{\n"
+        "  repository(owner: $owner, name: $repo) {{\n    {}\n  }}\n}}\n{}"
+    ).format(
+        ", ".join("$sha{}: String!".format(i) for i in range(len(shas))),
+        "\n    ".join(objects),
+        CULPRITS_GRAPHQL_FRAGMENT,
+    )
+    return {"query": query, "variables": variables}
+
 
-DEBUG = config("DEBUG", default=False)
-GITHUB_REQUEST_TIMEOUT = config("GITHUB_REQUEST_TIMEOUT", default=10)
-GITHUB_REQUEST_HEADERS = {
-    "User-Agent": config(
-        "REQUESTS_USER_AGENT", default="whatsdeployed (https://whatsdeployed.io)"
-    )
-}
-GITHUB_AUTH_TOKEN = config("GITHUB_AUTH_TOKEN", default=None)
-if GITHUB_AUTH_TOKEN:
-    GITHUB_REQUEST_HEADERS["Authorization"] = "token {}".format(GITHUB_AUTH_TOKEN)
-else:
-    warnings.warn("GITHUB_AUTH_TOKEN is NOT available. Worry about rate limits.")
+def culprits_from_graphql(owner, repo, shas, payload):
+    if not payload.get("data") or not payload["data"].get("repository"):
+        raise GraphQLError(
+            "; ".join(e.get("message", "") for e in payload.get("errors", []))
+            or "No data"
+        )
+    repository = payload["data"]["repository"]
 
-ROLLBAR_ACCESS_TOKEN = config("ROLLBAR_ACCESS_TOKEN", default=None)
-if ROLLBAR_ACCESS_TOKEN:
-    rollbar.init(ROLLBAR_ACCESS_TOKEN)
-    rollbar.report_message("Rollbar is configured correctly")
-    print("Rollbar enabled.")
-else:
-    print("Rollbar NOT enabled.")
+    def user(actor):
+        # The REST API's names for the same things. It's null for deleted
+        # accounts, which culprits_group() leaves out.
+        if actor is None:
+            return None
+        return {
+            "login": actor["login"],
+            "avatar_url": actor["avatarUrl"],
+            "html_url": actor["url"],
+        }
 
-# Set static_folder=None to suppress the standard static server
-app = Flask(__name__, static_folder=None)
-app.config["SQLALCHEMY_DATABASE_URI"] = config(
-    "SQLALCHEMY_DATABASE_URI", "postgres://localhost/whatsdeployed"
-)
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = DEBUG
-db = SQLAlchemy(app)
+    groups = {}
+    for i, sha in enumerate(shas):
+        commit = repository["sha{}".format(i)]
+        if commit is None:
+            raise GraphQLError("No commit {} in {}/{}".format(sha, owner, repo))
+        pr = None
+        comments = []
+        for node in commit["associatedPullRequests"]["nodes"]:
+            merge_commit = node["mergeCommit"]
+            if merge_commit and merge_commit["oid"].startswith(sha.lower()):
+                pr = {
+                    "_links": {"html": {"href": node["url"]}},
+                    "user": user(node["author"]),
+                    "assignees": [user(a) for a in node["assignees"]["nodes"] if a],
+                }
+                comments = [
+                    {"user": user(c["author"])}
+                    for c in node["comments"]["nodes"]
+                    if c["author"]
+                ]
+                break
+        groups[sha] = culprits_group(
+            pr,
+            comments,
+            {
+                "author": user((commit["author"] or {}).get("user")),
+                "committer": user((commit["committer"] or {}).get("user")),
+            },
+        )
+    return groups
 
 
-class Shortlink(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    link = db.Column(db.String(80), unique=True)
-    owner = db.Column(db.String(200))
-    repo = db.Column(db.String(200))
-    revisions = db.Column(db.Text)
+def culprits_cache_key(owner, repo, sha):
+    return "culprits:{}/{}:{}".format(owner, repo, sha)
 
-    def __init__(self, link, owner, repo, revisions):
-        self.link = link
-        self.owner = owner
-        self.repo = repo
-        assert isinstance(revisions, list), type(revisions)
-        self.revisions = json.dumps(revisions)
 
-    def __repr__(self):
-        return "<Shortlink %r>" % self.link
+def commit_cache_key(owner, repo, sha):
+    return "commit:{}/{}:{}".format(owner, repo, sha)
 
 
-def extract_sha(content):
-    content = content.strip()
+def iter_culprits(owner, repo, shas):
+    """Yield (sha, culprits group) for each sha as soon as it's been worked
+    out. Raises UpstreamError if GitHub can't be asked."""
+    to_look_up = []
+    for sha in shas:
+        # The culprits of a sha never change once worked out.
+        cached = permanent_cache.get(culprits_cache_key(owner, repo, sha))
+        if cached is not None:
+            yield sha, cached
+        else:
+            to_look_up.append(sha)
+    if not to_look_up:
+        return
 
-    if content.startswith("{") and content.endswith("}"):
-        # If it starts and ends with curly braces, it just might be a json
-        # object
+    if CULPRITS_BACKEND == "graphql":
         try:
-            data = json.loads(content)
-
-            # This is where it's at in Dockerflow-supported sites
-            if "commit" in data:
-                return data["commit"]
+            found = graphql_culprits(owner, repo, to_look_up)
+        except ReadTimeout:
+            raise UpstreamError(
+                "Timeout error trying to load {}".format(GITHUB_GRAPHQL_URL)
+            )
+        except GraphQLError as exception:
+            raise UpstreamError(str(exception))
+        for sha in to_look_up:
+            permanent_cache.set(culprits_cache_key(owner, repo, sha), found[sha])
+            yield sha, found[sha]
+        return
 
-        except json.decoder.JSONDecodeError:
-            pass
+    base_url, pulls_url = culprits_urls(owner, repo)
+    try:
+        pulls = run_steps(pulls_steps(base_url, pulls_url, to_look_up))
+    except ReadTimeout:
+        raise UpstreamError("Timeout error trying to load {}".format(pulls_url))
+    # Each of these gets its commit and comments on the executor.
+    futures = {
+        submit(
+            coordinator,
+            run_steps,
+            culprits_group_steps(base_url, owner, repo, sha, pulls.get(sha)),
+        ): sha
+        for sha in to_look_up
+    }
+    for future in as_completed(futures):
+        yield futures[future], future.result()
 
-    if 7 <= len(content) <= 40:
-        return content
 
+def culprits_urls(owner, repo):
+    """The base URL of the repo in the GitHub API and that of its recently
+    closed pull requests."""
+    base_url = GITHUB_API_URL + "/repos/{owner}/{repo}".format(repo=repo, owner=owner)
+    pulls_url = base_url + (
+        "/pulls?sort=created&state=closed&direction=desc&per_page=100"
+    )
+    return base_url, pulls_url
 
-class ShasView(MethodView):
-    def post(self):
-        deployments = []
-        environment = request.json
 
-        base_url = "https://api.github.com/repos/{owner}/{repo}".format(
-            repo=environment["repo"], owner=environment["owner"]
-        )
-        tags_url = base_url + ("/tags?sort=created&direction=desc")
+def pulls_steps(base_url, pulls_url, shas):
+    """Steps (see run_steps()) returning a dict of sha to the pull request
+    that was merged as that sha. Recently closed pull requests are paged
+    through until all the shas are found or CULPRITS_PULLS_MAX_PAGES is
+    reached. Whatever is still missing after that is looked up by its
+    commit instead."""
+    pulls = {}
+    url = pulls_url
+    for _ in range(CULPRITS_PULLS_MAX_PAGES):
+        (r,) = yield GitHubGets([url])
+        for pr in checked(r).json():
+            sha = pr["merge_commit_sha"]
+            if sha in shas and sha not in pulls:
+                pulls[sha] = pr
+        if len(pulls) == len(shas) or "next" not in r.links:
+            return pulls
+        url = r.links["next"]["url"]
 
-        tags = {}
-        while True:
-            try:
-                r = requests.get(
-                    tags_url,
-                    headers=GITHUB_REQUEST_HEADERS,
-                    timeout=GITHUB_REQUEST_TIMEOUT,
-                )
-                r.raise_for_status()
-                for tag in r.json():
-                    tags[tag["commit"]["sha"]] = tag["name"]
-                try:
-                    tags_url = r.links["next"]["url"]
-                except KeyError:
-                    break
-            except ReadTimeout:
+    missing = [sha for sha in shas if sha not in pulls]
+    responses = yield GitHubGets(
+        [base_url + "/commits/{sha}/pulls".format(sha=sha) for sha in missing]
+    )
+    for sha, r in zip(missing, responses):
+        for pr in checked(r).json():
+            if pr["merge_commit_sha"] == sha:
+                pulls[sha] = pr
                 break
+    return pulls
 
-        for each in environment["deployments"]:
-            name = each["name"]
-            url = each["url"]
 
-            # Skip empty urls
-            if not url:
-                continue
+def culprits_group_steps(base_url, owner, repo, sha, pr):
+    """Steps returning the culprits group of a sha, which is stored too.
+    Only the author and committer of the commit are kept, since the full
+    payload, with all its files, can be big."""
+    cache_key = commit_cache_key(owner, repo, sha)
+    commit = yield BlockingCall(permanent_cache.get, (cache_key,))
+    urls = []
+    if commit is None:
+        urls.append(base_url + "/commits/{sha}".format(sha=sha))
+    if pr:
+        urls.append(base_url + "/issues/{number}/comments".format(number=pr["number"]))
+    responses = (yield GitHubGets(urls)) if urls else []
+    if commit is None:
+        commit = trim_commit(checked(responses.pop(0)).json())
+        yield BlockingCall(permanent_cache.set, (cache_key, commit))
+    comments = checked(responses[0]).json() if pr else []
+    group = culprits_group(pr, comments, commit)
+    yield BlockingCall(
+        permanent_cache.set, (culprits_cache_key(owner, repo, sha), group)
+    )
+    return group
 
-            # Fetch the sha and balk if it doesn't exist
-            try:
-                response = self.fetch_content(url)
-                if response.status_code != 200:
-                    return make_response(
-                        jsonify(
-                            {
-                                "error": "{} trying to load {}".format(
-                                    response.status_code, url
-                                )
-                            }
-                        )
-                    )
-            except ReadTimeout:
-                return make_response(
-                    jsonify({"error": "Timeout error trying to load {}".format(url)})
-                )
-            content = response.text.strip()
-            sha = extract_sha(content)
-            if not sha:
-                # doesn't appear to be a git sha
-                error = "Doesn't look like a sha\n (%s) on %s" % (content, each["url"])
-                return make_response(jsonify({"error": error}))
 
-            deployments.append({"name": name, "sha": sha, "bugs": [], "url": url})
+def trim_commit(payload):
+    return {
+        "author": payload["author"],
+        "committer": payload.get("committer"),
+    }
 
-        response = make_response(jsonify({"deployments": deployments, "tags": tags}))
-        return response
 
-    def fetch_content(self, url):
-        if "?" in url:
-            url += "&"
-        else:
-            url += "?"
-        url += "cachescramble=%s" % time.time()
-        return requests.get(
-            url, headers=GITHUB_REQUEST_HEADERS, timeout=GITHUB_REQUEST_TIMEOUT
-        )
+def culprits_names(deployments):
+    """Return an ordered dict of sha to the name of the first deployment on
+    it. If you have, for example Stage on the exact same sha as Prod, then
+    there's no going looking it up twice."""
+    names = OrderedDict()
+    for deployment in deployments:
+        names.setdefault(deployment["sha"], deployment["name"])
+    return names
+
+
+def compute_culprits(owner, repo, deployments):
+    """Return what /culprits responds with. Raises UpstreamError if GitHub
+    can't be asked."""
+    names = culprits_names(deployments)
+    groups_by_sha = dict(iter_culprits(owner, repo, names))
+    groups = []
+    for sha, name in names.items():
+        groups.append(dict(groups_by_sha[sha], name=name))
+    return {"culprits": groups}
 
 
 class CulpritsView(MethodView):
     def post(self):
-        groups = []
+        owner = request.json["owner"]
+        repo = request.json["repo"]
         deployments = request.json["deployments"]
-        base_url = "https://api.github.com/repos/{owner}/{repo}".format(
-            repo=request.json["repo"], owner=request.json["owner"]
-        )
-        pulls_url = base_url + ("/pulls?sort=created&state=closed&direction=desc")
-        _looked_up = []
-        for deployment in deployments:
-            name = deployment["name"]
-            sha = deployment["sha"]
-            if sha in _looked_up:
-                # If you have, for example Stage on the exact same
-                # sha as Prod, then there's no going looking it up
-                # twice.
-                continue
 
-            users = []
-            links = []
+        result = None
+        if SNAPSHOTS:
+            result = get_snapshot(
+                Snapshot.culprits_key,
+                culprits_snapshot_key(owner, repo, deployments),
+                Snapshot.culprits,
+            )
+        if result is None:
             try:
-                r = requests.get(
-                    pulls_url,
-                    headers=GITHUB_REQUEST_HEADERS,
-                    timeout=GITHUB_REQUEST_TIMEOUT,
-                )
-                r.raise_for_status()
-            except ReadTimeout:
-                return make_response(
-                    jsonify(
-                        {"error": "Timeout error trying to load {}".format(pulls_url)}
-                    )
-                )
-
-            for pr in r.json():
-                if pr["merge_commit_sha"] == sha:
-                    links.append(pr["_links"]["html"]["href"])
-                    author = pr["user"]
-                    users.append(("Author", author))
-                    committer = pr.get("committer")
-                    if committer and committer != author:
-                        users.append(("Committer", committer))
-                    # let's also dig into what other people participated
-                    for assignee in pr["assignees"]:
-                        users.append(("Assignee", assignee))
-                    # Other people who commented on the PR
-                    issues_url = base_url + (
-                        "/issues/{number}/comments".format(number=pr["number"])
-                    )
-                    r = requests.get(
-                        issues_url,
-                        headers=GITHUB_REQUEST_HEADERS,
-                        timeout=GITHUB_REQUEST_TIMEOUT,
-                    )
-                    r.raise_for_status()
-                    for comment in r.json():
-                        try:
-                            user = comment["user"]
-                            users.append(("Commenter", user))
-                        except TypeError:
-                            print("COMMENT")
-                            print(comment)
-                    break
+                with deadline(REQUEST_DEADLINE):
+                    result = compute_culprits(owner, repo, deployments)
+            except UpstreamError as exception:
+                return make_response(jsonify({"error": str(exception)}))
 
-            commits_url = base_url + ("/commits/{sha}".format(sha=sha))
-            r = requests.get(
-                commits_url,
-                headers=GITHUB_REQUEST_HEADERS,
-                timeout=GITHUB_REQUEST_TIMEOUT,
-            )
-            r.raise_for_status()
-            commit = r.json()
-
-            author = commit["author"]
-            if ("Author", author) not in users:
-                users.append(("Author", author))
-            committer = commit.get("committer")
-            if committer:
-                if committer["login"] == "web-flow":
-                    # Then the author pressed the green button and let
-                    # GitHub merge it.
-                    # Change the label of the author to also be the committer
-                    users.append(("Committer", author))
-                elif committer != author:
-                    users.append(("Committer", committer))
-            # Now merge the labels for user
-            labels = defaultdict(list)
-            for label, user in users:
-                if label not in labels[user["login"]]:
-                    labels[user["login"]].append(label)
-            labels_map = {}
-            for login, labels in labels.items():
-                labels_map[login] = " & ".join(labels)
-            unique_users = []
-            _logins = set()
-            for _, user in users:
-                if user["login"] not in _logins:
-                    _logins.add(user["login"])
-                    unique_users.append((labels_map[user["login"]], user))
-            groups.append({"name": name, "users": unique_users, "links": links})
-            _looked_up.append(sha)
-
-        response = make_response(jsonify({"culprits": groups}))
+        response = make_response(jsonify(result))
         return response
 
 
+class CulpritsStreamView(MethodView):
+    """Like CulpritsView but the response is newline delimited JSON with one
+    record for each culprits group as soon as it's ready, then a summary."""
+
+    def post(self):
+        names = culprits_names(request.json["deployments"])
+        owner = request.json["owner"]
+        repo = request.json["repo"]
+
+        def generate():
+            t0 = time.time()
+            groups = 0
+            try:
+                with deadline(REQUEST_DEADLINE):
+                    for sha, group in iter_culprits(owner, repo, names):
+                        groups += 1
+                        yield ndjson_record(
+                            "culprits", group=dict(group, name=names[sha])
+                        )
+            except UpstreamError as exception:
+                yield ndjson_record("error", error=str(exception))
+            yield ndjson_record("summary", culprits=groups, took=time.time() - t0)
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+
+def compact_commit(commit):
+    """The few bits of a commit from the GitHub API the client shows."""
+    author = commit.get("author")
+    return {
+        "sha": commit["sha"],
+        "html_url": commit["html_url"],
+        "message": commit["commit"]["message"].split("\n")[0],
+        "date": commit["commit"]["author"]["date"],
+        "author_name": commit["commit"]["author"].get("name"),
+        "author": author
+        and {
+            "login": author["login"],
+            "avatar_url": author["avatar_url"],
+            "html_url": author["html_url"],
+        },
+    }
+
+
+def compare_shas(owner, repo, base, head):
+    """Return what's in 'head' but not in 'base', compactly. When both are
+    full shas the result can never change, so it's kept forever."""
+    immutable = all(re.fullmatch(r"[0-9a-f]{40}", sha) for sha in (base, head))
+    cache_key = "compare:{}/{}:{}...{}".format(owner, repo, base, head)
+    if immutable:
+        cached = permanent_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    r = github_get(
+        GITHUB_API_URL + "/repos/{}/{}/compare/{}...{}".format(owner, repo, base, head)
+    )
+    if r.status_code != 200:
+        raise UpstreamError(
+            "{} trying to compare {}...{}".format(r.status_code, base, head)
+        )
+    payload = r.json()
+    result = {
+        "status": payload["status"],
+        "ahead_by": payload["ahead_by"],
+        "behind_by": payload["behind_by"],
+        "total_commits": payload["total_commits"],
+        # Newest first, like the /commits listing.
+        "commits": [compact_commit(c) for c in reversed(payload["commits"])],
+    }
+    if immutable:
+        permanent_cache.set(cache_key, result)
+    return result
+
+
+class CompareView(MethodView):
+    """What commits each deployment has that the next one doesn't. Takes
+    the deployments (name and sha) in the order /shas returns them."""
+
+    def post(self):
+        owner = request.json["owner"]
+        repo = request.json["repo"]
+        deployments = request.json["deployments"]
+        pairs = list(zip(deployments, deployments[1:]))
+        with deadline(REQUEST_DEADLINE):
+            futures = [
+                submit(executor, compare_shas, owner, repo, base["sha"], head["sha"])
+                for head, base in pairs
+                if base["sha"] != head["sha"]
+            ]
+        futures.reverse()
+        comparisons = []
+        for head, base in pairs:
+            comparison = {
+                "head": head["name"],
+                "base": base["name"],
+                "head_sha": head["sha"],
+                "base_sha": base["sha"],
+            }
+            if base["sha"] == head["sha"]:
+                comparison.update(
+                    status="identical",
+                    ahead_by=0,
+                    behind_by=0,
+                    total_commits=0,
+                    commits=[],
+                )
+            else:
+                try:
+                    comparison.update(futures.pop().result())
+                except (UpstreamError, ReadTimeout) as exception:
+                    comparison["error"] = str(exception) or "Timeout"
+            comparisons.append(comparison)
+        return make_response(jsonify({"comparisons": comparisons}))
+
+
 class ShortenView(MethodView):
     def post(self):
         url = request.json["url"]
@@ -286,40 +2508,36 @@ class ShortenView(MethodView):
         for i, name in enumerate(parsed["name[]"]):
             revisions.append((name, parsed["url[]"][i]))
         # Does it already exist??
-        shortlink = Shortlink.query.filter_by(
-            owner=owner, repo=repo, revisions=json.dumps(revisions)
-        ).first()
+        hash_ = content_hash(owner, repo, revisions)
+        shortlink = Shortlink.query.filter_by(content_hash=hash_).first()
 
-        if shortlink is not None:
-            link = shortlink.link
-        else:
-
-            def new_random_link(length):
-                pool = "abcdefghijklmnopqrstuvwxyz0123456789"
-                pool += pool.upper()
-                new = ""
-                while len(new) < length:
-                    new += random.choice(list(pool))
-                return new
-
-            link = new_random_link(3)
-            while Shortlink.query.filter_by(link=link).count():
-                link = new_random_link(3)
-            shortlink = Shortlink(link, owner, repo, revisions)
+        if shortlink is None:
+            shortlink = Shortlink(None, owner, repo, revisions)
             db.session.add(shortlink)
-            db.session.commit()
+            try:
+                # The code is made from the id, so insert to get one.
+                db.session.flush()
+                shortlink.link = encode_link(shortlink.id)
+                db.session.commit()
+                shortlink_cache.invalidate(shortlink.link)
+            except IntegrityError:
+                # Someone shortened the very same thing at the same time.
+                db.session.rollback()
+                shortlink = Shortlink.query.filter_by(content_hash=hash_).one()
 
-        new_url = "/s-{}".format(link)
+        new_url = "/s-{}".format(shortlink.link)
         return make_response(jsonify({"url": new_url}))
 
 
 class LengthenView(MethodView):
     def get(self, link):
-        shortlink = Shortlink.query.filter_by(link=link).first()
+        shortlink = shortlink_cache.get(link)
         if shortlink is None:
             abort(404)
+        if SNAPSHOTS:
+            record_hit(shortlink)
         response = {"repo": shortlink.repo, "owner": shortlink.owner, "deployments": []}
-        for k, v in json.loads(shortlink.revisions):
+        for k, v in shortlink.revisions:
             response["deployments"].append({"name": k, "url": v})
         return make_response(jsonify(response))
 
@@ -331,32 +2549,111 @@ class ShortenedView(MethodView):
             abort(400)
         ids = [x.replace("/s-", "") for x in urls.split(",") if x.startswith("/s-")]
         environments = []
-        shortlinks = Shortlink.query.filter(Shortlink.link.in_(ids)).all()
-        for shortlink in shortlinks:
+        shortlinks = shortlink_cache.get_many(ids)
+        for shortlink in shortlinks.values():
             environments.append(
                 {
                     "shortlink": shortlink.link,
                     "owner": shortlink.owner,
                     "repo": shortlink.repo,
-                    "revisions": json.loads(shortlink.revisions),
+                    "revisions": shortlink.revisions,
                 }
             )
 
         return make_response(jsonify({"environments": environments}))
 
 
+def dashboard_summary(shortlink, shas, tags):
+    """Return the compact state of a shortlink's environments given the
+    results (sha or the exception) of each deployment URL and the tags."""
+    environments = []
+    for name, url in shortlink.revisions:
+        if not url:
+            continue
+        environment = {"name": name, "url": url}
+        result = shas[url]
+        if isinstance(result, Exception):
+            environment["error"] = str(result)
+        else:
+            environment["sha"] = result
+            environment["tag"] = tags.get(result)
+        environments.append(environment)
+    deployed = set(each.get("sha") for each in environments)
+    return {
+        "shortlink": shortlink.link,
+        "owner": shortlink.owner,
+        "repo": shortlink.repo,
+        "environments": environments,
+        "in_sync": len(deployed) == 1 and None not in deployed,
+    }
+
+
+def compute_dashboard(shortlinks):
+    """Return the dashboard_summary() of each shortlink. Every distinct
+    deployment URL is only fetched once, and the tags of every distinct
+    repo only once, no matter how many of the shortlinks share them."""
+    urls = set()
+    repos = set()
+    for shortlink in shortlinks:
+        urls.update(url for _, url in shortlink.revisions if url)
+        repos.add((shortlink.owner, shortlink.repo))
+    sha_futures = {url: submit(executor, deployment_sha, url) for url in urls}
+    # get_tags() fetches pages on the executor itself.
+    tag_futures = {key: submit(coordinator, get_tags, *key) for key in sorted(repos)}
+    shas = {}
+    for url, future in sha_futures.items():
+        try:
+            shas[url] = future.result()
+        except (UpstreamError, requests.exceptions.RequestException) as exception:
+            # E.g. a 404, a timeout or not even a valid URL.
+            shas[url] = exception
+    tags = {}
+    for key, future in tag_futures.items():
+        try:
+            tags[key] = future.result()
+        except (UpstreamError, requests.exceptions.RequestException):
+            # Without tags the shas are still worth showing.
+            tags[key] = {}
+    return [
+        dashboard_summary(shortlink, shas, tags[(shortlink.owner, shortlink.repo)])
+        for shortlink in shortlinks
+    ]
+
+
+class DashboardView(MethodView):
+    """The live state of many shortlinks at once, e.g.
+    /dashboard?urls=/s-abc,/s-xyz. A deployment that can't be loaded gets
+    an "error" instead of failing the whole response."""
+
+    def get(self):
+        urls = request.args.get("urls")
+        if not urls:
+            abort(400)
+        ids = [x.replace("/s-", "") for x in urls.split(",") if x.startswith("/s-")]
+        ids = list(OrderedDict.fromkeys(ids))
+        if len(ids) > DASHBOARD_MAX_SHORTLINKS:
+            abort(400)
+        found = shortlink_cache.get_many(ids)
+        shortlinks = [found[link] for link in ids if link in found]
+        with deadline(REQUEST_DEADLINE):
+            dashboards = compute_dashboard(shortlinks)
+        return make_response(jsonify({"dashboards": dashboards}))
+
+
 class ShortlinkRedirectView(MethodView):
     def get(self, link):
-        shortlink = Shortlink.query.filter_by(link=link).first()
+        shortlink = shortlink_cache.get(link)
         if shortlink is None:
             abort(404)
+        if SNAPSHOTS:
+            record_hit(shortlink)
         qs = {
             "repo": shortlink.repo,
             "owner": shortlink.owner,
             "name[]": [],
             "url[]": [],
         }
-        for k, v in json.loads(shortlink.revisions):
+        for k, v in shortlink.revisions:
             qs["name[]"].append(k)
             qs["url[]"].append(v)
         return redirect("/?" + urlencode(qs, True))
@@ -368,31 +2665,69 @@ class GitHubAPI(MethodView):
     do that clients are likely to hit rate limits."""
 
     def get(self, thing):
-        url = "https://api.github.com"
         if thing == "commits":
-            copied = dict(request.args)
-            owner = request.args.get("owner")
-            repo = request.args.get("repo")
-            if not owner:
-                abort(400, "No 'owner'")
-            if not repo:
-                abort(400, "No 'repo'")
-
-            url += "/repos/{}/{}/commits".format(owner, repo)
-            copied.pop("owner")
-            copied.pop("repo")
-            if copied:
-                url += "?" + urlencode(copied, True)
-            response = requests.get(
-                url, headers=GITHUB_REQUEST_HEADERS, timeout=GITHUB_REQUEST_TIMEOUT
-            )
+            response = github_get(self.commits_url(request.args))
             if response.status_code == 200:
-                return make_response(jsonify(response.json()))
+                return self.passthrough(
+                    response, request.if_none_match, request.accept_encodings
+                )
             else:
                 abort(response.status_code, response.content)
         else:
             abort(400)
 
+    @staticmethod
+    def commits_url(args):
+        url = GITHUB_API_URL
+        copied = dict(args)
+        owner = args.get("owner")
+        repo = args.get("repo")
+        if not owner:
+            abort(400, "No 'owner'")
+        if not repo:
+            abort(400, "No 'repo'")
+
+        url += "/repos/{}/{}/commits".format(owner, repo)
+        copied.pop("owner")
+        copied.pop("repo")
+        if copied:
+            url += "?" + urlencode(copied, True)
+        return url
+
+    # Gzipped response bodies by ETag, so they're only compressed once.
+    gzipped = MemoryCacheBackend(10 * 1024 * 1024)
+
+    def passthrough(self, upstream_response, if_none_match, accept_encodings):
+        """Respond with the upstream JSON exactly as it came (no decoding and
+        encoding it again), gzipped if the client wants, with an ETag the
+        client can revalidate against."""
+        body = upstream_response.content
+        etag = upstream_response.headers.get("ETag")
+        if not etag:
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        tag, _ = unquote_etag(etag)
+        if if_none_match.contains_weak(tag):
+            response = make_response("", 304)
+        else:
+            response = make_response(body)
+            response.mimetype = "application/json"
+            if "gzip" in accept_encodings and len(body) > 1024:
+                entry = self.gzipped.get(etag)
+                if entry is None:
+                    entry = CacheEntry(None, etag, {}, gzip.compress(body))
+                    self.gzipped.set(etag, entry)
+                response.set_data(entry.body)
+                response.headers["Content-Encoding"] = "gzip"
+        response.headers["ETag"] = etag
+        response.headers["Vary"] = "Accept-Encoding"
+        if GITHUBAPI_MAX_AGE:
+            response.headers["Cache-Control"] = "private, max-age={}".format(
+                GITHUBAPI_MAX_AGE
+            )
+        else:
+            response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
 
 class HealthCheckView(MethodView):
     """A dumb but comprehensive health check"""
@@ -413,37 +2748,527 @@ class HealthCheckView(MethodView):
         return "OK\n"
 
 
+def verify_signature(secret, body, signature):
+    """Whether the X-Hub-Signature-256 header is the HMAC of the body."""
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, "sha256").hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+def tag_indexes_of(owner, repo):
+    """Where clause for the TagIndex rows of a repo however its name was
+    capitalized in the shortlinks. GitHub doesn't care."""
+    table = TagIndex.__table__
+    return (db.func.lower(table.c.owner) == owner.lower()) & (
+        db.func.lower(table.c.repo) == repo.lower()
+    )
+
+
+def mark_tag_index_stale(owner, repo):
+    """Make the next get_tags() check GitHub for new tags."""
+    table = TagIndex.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            table.update().where(tag_indexes_of(owner, repo)).values(refreshed=0)
+        )
+
+
+def forget_github_responses(owner, repo, *paths):
+    """Drop the stored GitHub responses of the repo's URLs under 'paths'."""
+    if github_cache is None:
+        return 0
+    base_url = GITHUB_API_URL + "/repos/{owner}/{repo}".format(owner=owner, repo=repo)
+    return sum(github_cache.forget(base_url + path) for path in paths)
+
+
+def handle_tag_event(owner, repo):
+    # Whether it was created or deleted, the next get_tags() notices.
+    mark_tag_index_stale(owner, repo)
+    return ["tag index stale"]
+
+
+def handle_push(owner, repo, payload):
+    ref = payload["ref"]
+    if ref.startswith("refs/tags/"):
+        return handle_tag_event(owner, repo)
+    # Commit lists and comparisons are revalidated with their ETags anyway.
+    return []
+
+
+def handle_create(owner, repo, payload):
+    if payload["ref_type"] != "tag":
+        return []
+    return handle_tag_event(owner, repo)
+
+
+def handle_delete(owner, repo, payload):
+    if payload["ref_type"] != "tag":
+        return []
+    return handle_tag_event(owner, repo)
+
+
+def handle_pull_request(owner, repo, payload):
+    done = []
+    forgotten = forget_github_responses(
+        owner, repo, "/pulls", "/issues/{}/".format(payload["number"])
+    )
+    done.append("{} pull request lists forgotten".format(forgotten))
+    sha = payload["pull_request"].get("merge_commit_sha")
+    if sha:
+        # The culprits of a sha are otherwise kept forever.
+        permanent_cache.delete(culprits_cache_key(owner, repo, sha))
+        done.append("culprits of {} forgotten".format(sha))
+    return done
+
+
+def handle_release(owner, repo, payload):
+    # Publishing a release can create its tag.
+    return handle_tag_event(owner, repo)
+
+
+WEBHOOK_HANDLERS = {
+    "push": handle_push,
+    "create": handle_create,
+    "delete": handle_delete,
+    "pull_request": handle_pull_request,
+    "release": handle_release,
+}
+
+
+class GitHubWebhookView(MethodView):
+    """Receives GitHub webhooks so the tag index and cached GitHub data are
+    updated as soon as a repo changes rather than when they expire. Set the
+    webhook's content type to application/json and its secret to
+    GITHUB_WEBHOOK_SECRET."""
+
+    def post(self):
+        if not GITHUB_WEBHOOK_SECRET:
+            abort(404)
+        body = request.get_data()
+        signature = request.headers.get("X-Hub-Signature-256")
+        if not verify_signature(GITHUB_WEBHOOK_SECRET, body, signature):
+            abort(403)
+        event = request.headers.get("X-GitHub-Event")
+        handler = WEBHOOK_HANDLERS.get(event)
+        if handler is None:
+            # Including "ping", which GitHub sends when the hook is set up.
+            return make_response(jsonify({"event": event, "done": []}))
+        payload = json.loads(body)
+        repository = payload["repository"]
+        done = handler(repository["owner"]["login"], repository["name"], payload)
+        return make_response(jsonify({"event": event, "done": done}))
+
+
 app.add_url_rule("/shas", view_func=ShasView.as_view("shas"))
 app.add_url_rule("/culprits", view_func=CulpritsView.as_view("culprits"))
+app.add_url_rule("/shas/stream", view_func=ShasStreamView.as_view("shas_stream"))
+app.add_url_rule(
+    "/culprits/stream", view_func=CulpritsStreamView.as_view("culprits_stream")
+)
+app.add_url_rule("/compare", view_func=CompareView.as_view("compare"))
 app.add_url_rule("/shortenit", view_func=ShortenView.as_view("shortenit"))
 app.add_url_rule(
     "/lengthenit/<string:link>", view_func=LengthenView.as_view("lengthenit")
 )
 app.add_url_rule("/shortened", view_func=ShortenedView.as_view("shortened"))
+app.add_url_rule("/dashboard", view_func=DashboardView.as_view("dashboard"))
+app.add_url_rule(
+    "/webhooks/github", view_func=GitHubWebhookView.as_view("github_webhook")
+)
 app.add_url_rule("/githubapi/<string:thing>", view_func=GitHubAPI.as_view("githubapi"))
 app.add_url_rule(
     "/s-<string:link>", view_func=ShortlinkRedirectView.as_view("shortlink")
 )
+
+
+class StatsView(MethodView):
+    """Internal numbers about how the upstream connections are doing."""
+
+    def get(self):
+        stats = {"upstream": upstream.stats()}
+        if github_cache is not None:
+            stats["github_cache"] = github_cache.stats()
+        stats["permanent_cache"] = permanent_cache.stats()
+        stats["shortlink_cache"] = shortlink_cache.stats()
+        stats["single_flight"] = single_flight.stats()
+        stats["rate_limits"] = token_pool.stats()
+        if DEPLOYMENT_CACHE_TTL:
+            stats["deployment_cache"] = deployment_cache.stats()
+        stats["circuit_breakers"] = {
+            "deployments": deployment_breaker.stats(),
+            "github": github_breaker.stats(),
+        }
+        return make_response(jsonify(stats))
+
+
+class MetricsView(MethodView):
+    """The request and upstream timings plus what /__stats__ knows, for
+    Prometheus to scrape."""
+
+    def get(self):
+        samples = []
+        caches = {
+            "permanent": permanent_cache.stats(),
+            "shortlink": shortlink_cache.stats(),
+        }
+        if github_cache is not None:
+            caches["github"] = github_cache.stats()
+        if DEPLOYMENT_CACHE_TTL:
+            caches["deployment"] = deployment_cache.stats()
+            # A stale sha is still served from the cache.
+            caches["deployment"]["hits"] += caches["deployment"]["stale"]
+        for cache, stats in caches.items():
+            labels = {"cache": cache}
+            samples.append(("cache_hits_total", "counter", labels, stats["hits"]))
+            samples.append(("cache_misses_total", "counter", labels, stats["misses"]))
+            total = stats["hits"] + stats["misses"]
+            if total:
+                ratio = stats["hits"] / total
+                samples.append(("cache_hit_ratio", "gauge", labels, ratio))
+
+        rate_limits = token_pool.stats()
+        for budget in rate_limits["tokens"]:
+            labels = {"token": budget["token"], "resource": budget["resource"]}
+            samples.append(
+                ("github_rate_limit_remaining", "gauge", labels, budget["remaining"])
+            )
+            samples.append(("github_rate_limit", "gauge", labels, budget["limit"]))
+        samples.append(
+            (
+                "github_rate_limit_exhausted_total",
+                "counter",
+                {},
+                rate_limits["exhausted"],
+            )
+        )
+
+        for name, breaker in (
+            ("deployments", deployment_breaker),
+            ("github", github_breaker),
+        ):
+            stats = breaker.stats()
+            labels = {"breaker": name}
+            samples.append(("circuits_open", "gauge", labels, len(stats["open"])))
+            samples.append(
+                ("circuit_rejected_total", "counter", labels, stats["rejected"])
+            )
+
+        stats = single_flight.stats()
+        samples.append(("single_flight_leaders_total", "counter", {}, stats["leaders"]))
+        samples.append(
+            ("single_flight_coalesced_total", "counter", {}, stats["coalesced"])
+        )
+
+        for host, stats in upstream.stats().items():
+            labels = {"host": host}
+            samples.append(
+                ("upstream_connections_total", "counter", labels, stats["connections"])
+            )
+
+        response = make_response(metrics.render(samples))
+        response.mimetype = "text/plain; version=0.0.4"
+        return response
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    started = getattr(g, "started", None)
+    if started is not None:
+        endpoint = request.endpoint or "none"
+        metrics.observe(
+            "request_duration_seconds",
+            time.perf_counter() - started,
+            endpoint=endpoint,
+        )
+        metrics.inc("responses_total", endpoint=endpoint, status=response.status_code)
+    return response
+
+
 app.add_url_rule("/__healthcheck__", view_func=HealthCheckView.as_view("healthcheck"))
+app.add_url_rule("/__stats__", view_func=StatsView.as_view("stats"))
+app.add_url_rule("/__metrics__", view_func=MetricsView.as_view("metrics"))
+
+
+def refresh_snapshot(link):
+    """Recompute the /shas and /culprits responses for a shortlink. If
+    either fails, that snapshot is cleared so requests fetch it live."""
+    shortlinks = Shortlink.__table__
+    with db.engine.begin() as connection:
+        shortlink = connection.execute(
+            shortlinks.select().where(shortlinks.c.link == link)
+        ).first()
+    if shortlink is None:
+        return
+    values = {"shas": None, "culprits": None, "refreshed": time.time()}
+    try:
+        shas = compute_shas(
+            shortlink.owner, shortlink.repo, json.loads(shortlink.revisions), True
+        )
+        values["shas"] = json.dumps(shas)
+        values["culprits_key"] = culprits_snapshot_key(
+            shortlink.owner, shortlink.repo, shas["deployments"]
+        )
+        values["culprits"] = json.dumps(
+            compute_culprits(shortlink.owner, shortlink.repo, shas["deployments"])
+        )
+    except (UpstreamError, requests.exceptions.RequestException) as exception:
+        print("Unable to refresh snapshot of {}: {}".format(link, exception))
+    table = Snapshot.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.update().where(table.c.link == link).values(**values))
+
+
+@app.cli.command("refresh-snapshots")
+@click.option("--top", default=50, help="How many of the most hit shortlinks")
+@click.option("--interval", default=30, help="Seconds between each refresh")
+@click.option("--days", default=7, help="Only shortlinks requested this recently")
+@click.option("--once", is_flag=True, help="Refresh once and exit")
+@click.option(
+    "--concurrency", default=4, help="How many shortlinks to refresh at a time"
+)
+def refresh_snapshots(top, interval, days, once, concurrency):
+    """Keep the snapshots of the most requested shortlinks fresh."""
+    table = Snapshot.__table__
+    # Not the coordinator, since refreshing waits on jobs in that.
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    while True:
+        t0 = time.time()
+        with db.engine.begin() as connection:
+            links = [
+                row.link
+                for row in connection.execute(
+                    db.select([table.c.link])
+                    .where(table.c.last_hit > t0 - days * 24 * 60 * 60)
+                    .order_by(table.c.hits.desc())
+                    .limit(top)
+                )
+            ]
+        for _ in pool.map(refresh_snapshot, links):
+            pass
+        print("Refreshed {} snapshots in {:.2f}s".format(len(links), time.time() - t0))
+        if once:
+            break
+        time.sleep(max(0, interval - (time.time() - t0)))
+
+
+@app.errorhandler(UpstreamError)
+@app.errorhandler(requests.exceptions.RequestException)
+def upstream_error(exception):
+    """For when a view doesn't turn these into an {"error": ...} itself."""
+    if isinstance(exception, (DeadlineExceeded, requests.exceptions.Timeout)):
+        status = 504
+    elif isinstance(exception, CircuitOpen):
+        status = 503
+    else:
+        status = 502
+    return make_response(jsonify({"error": str(exception)}), status)
+
+
+@app.errorhandler(RateLimitExhausted)
+def rate_limit_exhausted(exception):
+    response = make_response(jsonify({"error": str(exception)}), 503)
+    response.headers["Retry-After"] = str(int(exception.retry_after) + 1)
+    return response
+
+
+# One file in ./build/. 'bodies' is content encoding (None for none) to
+# the bytes to send, and 'etags' the strong ETag of each of those.
+StaticAsset = namedtuple("StaticAsset", "mimetype bodies etags cache_control")
+
+
+class StaticAssets:
+    """Everything in ./build/, read once, with the gzip (and brotli, if
+    that's installed) versions worked out up front. ./bin/build.sh already
+    makes .gz and .br files of the bigger assets, and those are used when
+    they're there. Nothing is read until load() is called or the first
+    asset is asked for."""
+
+    # Files that are smaller than this aren't worth compressing.
+    COMPRESS_MIN_BYTES = 1024
+    # Only these get compressed here, when ./bin/build.sh didn't already.
+    # Images and fonts are compressed already, and source maps are JSON.
+    COMPRESSIBLE = re.compile(
+        r"^(text/|application/(javascript|json|xml|manifest\+json)|image/svg)"
+    )
+    COMPRESSIBLE_SUFFIXES = (".map",)
+    # Not the slow defaults (9 and 11) since this happens at startup, and
+    # the bigger assets come precompressed by ./bin/build.sh anyway.
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+    # Create React App puts a content hash in the names, like
+    # static/js/main.1a2b3c4d.chunk.js, so those can be cached forever.
+    FINGERPRINTED = re.compile(r"^static/.*\.[0-9a-f]{8,}\.")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = None
+        self.lock = threading.Lock()
+
+    def load_all(self):
+        with self.lock:
+            if self.assets is None:
+                self.assets = self.read(self.directory)
+        return self.assets
+
+    def read(self, directory):
+        paths = set()
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(root, filename), directory)
+                paths.add(path.replace(os.sep, "/"))
+        assets = {}
+        for path in paths:
+            if path.endswith((".gz", ".br")) and path[:-3] in paths:
+                # The precompressed version of another file.
+                continue
+            assets[path] = self.load(directory, path)
+        return assets
+
+    def load(self, directory, path):
+        filepath = os.path.join(directory, path)
+        with open(filepath, "rb") as f:
+            body = f.read()
+        bodies = {None: body}
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        compressible = bool(self.COMPRESSIBLE.match(mimetype)) or path.endswith(
+            self.COMPRESSIBLE_SUFFIXES
+        )
+        if len(body) >= self.COMPRESS_MIN_BYTES:
+            for encoding, suffix, compress in (
+                ("gzip", ".gz", self.compress_gzip),
+                ("br", ".br", brotli and self.compress_brotli),
+            ):
+                if os.path.isfile(filepath + suffix):
+                    with open(filepath + suffix, "rb") as f:
+                        compressed = f.read()
+                elif compress and compressible:
+                    compressed = compress(body)
+                else:
+                    continue
+                # Images and such are often compressed already.
+                if len(compressed) < len(body) * 0.9:
+                    bodies[encoding] = compressed
+        digest = hashlib.sha1(body).hexdigest()
+        etags = {
+            encoding: '"{}{}"'.format(digest, "-" + encoding if encoding else "")
+            for encoding in bodies
+        }
+        if self.FINGERPRINTED.match(path):
+            cache_control = "public, max-age=31536000, immutable"
+        else:
+            cache_control = "no-cache"
+        return StaticAsset(mimetype, bodies, etags, cache_control)
+
+    def compress_gzip(self, body):
+        return gzip.compress(body, compresslevel=self.GZIP_LEVEL)
+
+    def compress_brotli(self, body):
+        return brotli.compress(body, quality=self.BROTLI_QUALITY)
+
+    def get(self, path):
+        return (self.assets or self.load_all()).get(path)
+
+    def __len__(self):
+        return len(self.assets or self.load_all())
+
+
+static_assets = StaticAssets(os.path.join(app.root_path, "build"))
 
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
 def index_html(path):
     # try to serve static files out of ./build/
-    try:
-        return send_from_directory("build", path)
-    except werkzeug.exceptions.NotFound:
+    if path.endswith("/"):
         # try to serve index.html in the requested path
-        if path.endswith("/"):
-            return send_from_directory("build", path + "index.html")
-        else:
-            # fall back to index.html
-            return send_file("build/index.html")
+        asset = static_assets.get(path + "index.html")
+    else:
+        # fall back to index.html
+        asset = static_assets.get(path) or static_assets.get("index.html")
+    if asset is None:
+        abort(404)
+
+    encoding = None
+    for candidate in ("br", "gzip"):
+        if candidate in asset.bodies and candidate in request.accept_encodings:
+            encoding = candidate
+            break
+    etag = asset.etags[encoding]
+    if request.if_none_match.contains(unquote_etag(etag)[0]):
+        response = make_response("", 304)
+    else:
+        response = make_response(asset.bodies[encoding])
+        response.mimetype = asset.mimetype
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = asset.cache_control
+    if len(asset.bodies) > 1:
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def init_rollbar():
+    if ROLLBAR_ACCESS_TOKEN:
+        # With the "thread" handler the message is sent in the background,
+        # so a slow Rollbar can't hold up startup.
+        rollbar.init(ROLLBAR_ACCESS_TOKEN, handler="thread")
+        rollbar.report_message("Rollbar is configured correctly")
+        print("Rollbar enabled.")
+    else:
+        print("Rollbar NOT enabled.")
+
+
+startup_lock = threading.Lock()
+started = False
+
+
+def process_started():
+    """When this process started, as a time.time(), so how long starting
+    took includes the interpreter and importing everything. Where there's
+    no /proc it's when this module was imported."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The process' start time, in clock ticks since boot, is the
+            # 22nd field. The 2nd is the command, which can have spaces.
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return imported
+
+
+@app.before_first_request
+def create_app():
+    """Do the startup work that importing this module doesn't, and return
+    the app. Pre-forking servers should call this in the parent, e.g.
+    gunicorn --preload 'app:create_app()', so it's done once and not in
+    every worker. If nothing calls it, the first request does."""
+    global started
+    with startup_lock:
+        if started:
+            return app
+        init_rollbar()
+        static_assets.load_all()
+        started = True
+    print(
+        "Started in {:.3f}s ({} static assets)".format(
+            time.time() - process_started(), len(static_assets)
+        )
+    )
+    return app
 
 
 if __name__ == "__main__":
     db.create_all()
+    migrate_shortlinks()
+    migrate_tag_index()
+    create_app()
 
     app.debug = DEBUG
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+"""Serve the app over ASGI, where /shas, /culprits and /githubapi/commits
+are coroutines on an async HTTP client instead of each holding a thread
+while they wait for GitHub and the deployment URLs. Everything else is the
+Flask app as usual, run in threads by asgiref.
+
+It needs a few more packages than the Flask app does:
+
+    pip install httpx asgiref uvicorn
+    uvicorn asgi:application
+
+The caches, single flight, token pool, circuit breakers and deadline of
+app.py all apply the same way. Database queries (tag index, permanent
+cache, snapshots) are short and run in app.py's executor.
+"""
+import asyncio
+import json
+import time
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import parse_qsl
+
+import httpx
+import requests
+from asgiref.wsgi import WsgiToAsgi
+from requests.exceptions import ReadTimeout
+from requests.structures import CaseInsensitiveDict
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_accept_header, parse_etags
+from werkzeug.test import EnvironBuilder
+
+import app as whatsdeployed
+from app import (
+    CULPRITS_BACKEND,
+    DEPLOYMENT_CACHE_TTL,
+    DEPLOYMENT_MAX_BYTES,
+    GITHUB_GRAPHQL_URL,
+    GITHUB_RATE_LIMIT_MAX_WAIT,
+    GITHUB_REQUEST_HEADERS,
+    REQUEST_DEADLINE,
+    SINGLE_FLIGHT,
+    SNAPSHOTS,
+    UPSTREAM_POOL_CONNECTIONS,
+    UPSTREAM_POOL_MAXSIZE,
+    UPSTREAM_RETRIES,
+    UPSTREAM_RETRY_BACKOFF,
+    DeploymentResponse,
+    GitHubAPI,
+    GitHubGets,
+    GraphQLError,
+    ShaReader,
+    Snapshot,
+    UpstreamError,
+    content_hash,
+    culprits_cache_key,
+    culprits_from_graphql,
+    culprits_graphql_query,
+    culprits_group_steps,
+    culprits_names,
+    culprits_snapshot_key,
+    culprits_urls,
+    deadline,
+    deployment_breaker,
+    deployment_cache,
+    filter_tags,
+    get_snapshot,
+    github_breaker,
+    github_cache,
+    has_full_timeout,
+    is_rate_limited,
+    metrics,
+    permanent_cache,
+    pulls_steps,
+    scramble,
+    sha_from_response,
+    submit,
+    tags_steps,
+    token_pool,
+    upstream_route,
+    upstream_timeout,
+)
+from app import _deployment_sha as sync_deployment_sha
+from flask import abort, jsonify
+
+
+def blocking(function, *args, **kwargs):
+    """Run something that blocks, like a database query, in the executor
+    and await it. It gets the current_deadline like with submit()."""
+    # Looked up each time since a forked worker gets a new executor.
+    return asyncio.wrap_future(
+        submit(whatsdeployed.executor, function, *args, **kwargs)
+    )
+
+
+class AsyncUpstreamClient:
+    """The async counterpart of app.UpstreamClient. Responses are turned
+    into requests.Response objects and httpx's exceptions into those of
+    requests, so everything in app.py that looks at responses (the token
+    pool, circuit breakers, ETag cache, ...) works the same."""
+
+    # The statuses the requests Retry in UpstreamClient retries.
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, max_connections, max_keepalive, retries, backoff_factor):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+        )
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.client = None
+
+    def start(self):
+        # Never store cookies, same as UpstreamClient.
+        cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        self.client = httpx.AsyncClient(
+            cookies=cookies,
+            # The client's own limits don't apply when it's given a transport.
+            # This one also retries failed connection attempts.
+            transport=httpx.AsyncHTTPTransport(
+                limits=self.limits, retries=self.retries
+            ),
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get(self, url, headers=None, read=None):
+        return await self.request("GET", url, headers, read)
+
+    async def post(self, url, headers=None, json=None):
+        return await self.request("POST", url, headers, json=json)
+
+    async def request(self, method, url, headers, read=None, **kwargs):
+        """Return what 'read' (a coroutine function) makes of the streamed
+        response. By default that's the whole of it as a requests.Response."""
+        if self.client is None:
+            self.start()
+        route = upstream_route(url)
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                async with self.client.stream(
+                    method, url, headers=headers, timeout=upstream_timeout(), **kwargs
+                ) as response:
+                    retry = (
+                        response.status_code in self.RETRY_STATUSES
+                        and attempt < self.retries
+                    )
+                    if not retry:
+                        result = await (read or self.read)(response)
+            except httpx.ConnectTimeout as exception:
+                metrics.inc("upstream_timeouts_total", route=route)
+                raise requests.exceptions.ConnectTimeout(str(exception))
+            except httpx.TimeoutException as exception:
+                metrics.inc("upstream_timeouts_total", route=route)
+                raise ReadTimeout(str(exception))
+            except (httpx.UnsupportedProtocol, httpx.InvalidURL) as exception:
+                raise requests.exceptions.InvalidURL(str(exception))
+            except httpx.TransportError as exception:
+                metrics.inc("upstream_errors_total", route=route)
+                raise requests.exceptions.ConnectionError(str(exception))
+            finally:
+                metrics.observe(
+                    "upstream_request_duration_seconds",
+                    time.perf_counter() - started,
+                    route=route,
+                )
+            metrics.inc(
+                "upstream_responses_total", route=route, status=response.status_code
+            )
+            if not retry:
+                return result
+            await asyncio.sleep(self.backoff_factor * 2**attempt)
+
+    async def read(self, response):
+        await response.aread()
+        return self.as_requests_response(response)
+
+    @staticmethod
+    def as_requests_response(response):
+        converted = requests.Response()
+        converted.status_code = response.status_code
+        converted.reason = response.reason_phrase
+        converted.url = str(response.url)
+        converted.headers = CaseInsensitiveDict(response.headers)
+        converted._content = response.content
+        converted.encoding = response.encoding
+        return converted
+
+
+upstream = AsyncUpstreamClient(
+    # Like UpstreamClient's pools, but httpx limits them all together.
+    max_connections=UPSTREAM_POOL_CONNECTIONS * UPSTREAM_POOL_MAXSIZE,
+    max_keepalive=UPSTREAM_POOL_MAXSIZE,
+    retries=UPSTREAM_RETRIES,
+    backoff_factor=UPSTREAM_RETRY_BACKOFF,
+)
+
+
+class AsyncSingleFlight:
+    """Like app.SingleFlight, for coroutines: while a call for a key is
+    running, other calls for it wait for its result."""
+
+    def __init__(self):
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, function, *args):
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = self.calls[key] = asyncio.ensure_future(function(*args))
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # One of the waiting requests giving up mustn't cancel it for all.
+        return await asyncio.shield(task)
+
+
+single_flight = AsyncSingleFlight()
+
+
+async def breaker_call(breaker, key, function, *args, **kwargs):
+    """CircuitBreaker.call() for coroutines."""
+    breaker.check(key)
+    full_timeout = has_full_timeout()
+    try:
+        response = await function(*args, **kwargs)
+    except BaseException as exception:
+        breaker.error(key, exception, full_timeout)
+        raise
+    breaker.record(key, response)
+    return response
+
+
+async def acquire_token(resource="core"):
+    if GITHUB_RATE_LIMIT_MAX_WAIT:
+        # It might sleep until a rate limit resets.
+        return await blocking(token_pool.acquire, resource)
+    return token_pool.acquire(resource)
+
+
+async def github_get(url):
+    if SINGLE_FLIGHT == "off":
+        return await _github_get(url)
+    return await single_flight.do(("github", url), _github_get, url)
+
+
+async def _github_get(url):
+    for _ in token_pool.tokens:
+        token = await acquire_token()
+        headers = token_pool.headers(token)
+        if github_cache is None:
+            response = await breaker_call(
+                github_breaker, "GitHub", upstream.get, url, headers
+            )
+        else:
+            response = await breaker_call(
+                github_breaker, "GitHub", conditional_get, url, headers
+            )
+        token_pool.update(token, response)
+        if not is_rate_limited(response):
+            break
+    return response
+
+
+async def conditional_get(url, headers):
+    """app.ConditionalRequestCache.get() for coroutines."""
+    key, entry, headers = await blocking(
+        github_cache.prepare, url, headers, token_pool.identity
+    )
+    response = await upstream.get(url, headers)
+    return await blocking(github_cache.finish, key, entry, url, response)
+
+
+async def run_steps(steps):
+    """app.run_steps() for coroutines: the GitHubGets of the generator are
+    awaited together and its BlockingCalls run in the executor."""
+    value = None
+    while True:
+        try:
+            step = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, GitHubGets):
+            value = await asyncio.gather(
+                *[github_get(url) for url in step.urls], return_exceptions=True
+            )
+        else:
+            value = await blocking(step.function, *step.args)
+
+
+async def get_tags(owner, repo):
+    return await run_steps(tags_steps(owner, repo))
+
+
+async def fetch_content(url):
+    if SINGLE_FLIGHT == "off":
+        return await _fetch_content(url)
+    return await single_flight.do(("deployment", url), _fetch_content, url)
+
+
+async def _fetch_content(url):
+    # Like app._fetch_content(), all of it has to be done in one timeout.
+    expires = time.monotonic() + upstream_timeout()
+
+    def read(response):
+        return read_sha(response, expires)
+
+    return await upstream.get(scramble(url), GITHUB_REQUEST_HEADERS, read)
+
+
+async def read_sha(response, expires=None):
+    """Like app._fetch_content(), read only as much as it takes to find the
+    sha and return a DeploymentResponse."""
+    reader = ShaReader(DEPLOYMENT_MAX_BYTES, response.charset_encoding, expires)
+    if response.status_code == 200:
+        # Each piece as it arrives. With a size it waits for that much.
+        async for chunk in response.aiter_bytes():
+            if reader.feed(chunk):
+                break
+    return DeploymentResponse(response.status_code, reader.content, reader.result())
+
+
+async def deployment_sha(url, force=False):
+    if not DEPLOYMENT_CACHE_TTL:
+        return await _deployment_sha(url)
+    if not force:
+        # Stale shas are refreshed from the executor, the synchronous way.
+        sha = deployment_cache.lookup(url, sync_deployment_sha)
+        if sha is not None:
+            return sha
+    try:
+        sha = await _deployment_sha(url)
+    except UpstreamError:
+        deployment_cache.forget(url)
+        raise
+    deployment_cache.set(url, sha)
+    return sha
+
+
+async def _deployment_sha(url):
+    try:
+        response = await breaker_call(deployment_breaker, url, fetch_content, url)
+    except ReadTimeout:
+        raise UpstreamError("Timeout error trying to load {}".format(url))
+    except requests.exceptions.ConnectionError:
+        raise UpstreamError("Unable to connect to {}".format(url))
+    except requests.exceptions.RequestException:
+        raise UpstreamError("Unable to load {}".format(url))
+    return sha_from_response(url, response)
+
+
+async def compute_shas(owner, repo, revisions, force=False):
+    to_fetch = [(name, url) for name, url in revisions if url]
+    fetching = asyncio.gather(*[deployment_sha(url, force) for _, url in to_fetch])
+    try:
+        tags = await get_tags(owner, repo)
+        shas = await fetching
+    finally:
+        # Only does anything if getting the tags failed.
+        fetching.cancel()
+    deployments = [
+        {"name": name, "sha": sha, "bugs": [], "url": url}
+        for (name, url), sha in zip(to_fetch, shas)
+    ]
+    return {"deployments": deployments, "tags": tags}
+
+
+async def graphql_culprits(owner, repo, shas):
+    token = await acquire_token("graphql")
+    r = await breaker_call(
+        github_breaker,
+        "GitHub",
+        upstream.post,
+        GITHUB_GRAPHQL_URL,
+        token_pool.headers(token),
+        json=culprits_graphql_query(owner, repo, shas),
+    )
+    token_pool.update(token, r)
+    r.raise_for_status()
+    return culprits_from_graphql(owner, repo, shas, r.json())
+
+
+def get_cached_culprits(owner, repo, shas):
+    return {
+        sha: permanent_cache.get(culprits_cache_key(owner, repo, sha)) for sha in shas
+    }
+
+
+def set_cached_culprits(owner, repo, groups):
+    for sha, group in groups.items():
+        permanent_cache.set(culprits_cache_key(owner, repo, sha), group)
+
+
+async def find_culprits(owner, repo, shas):
+    """Return a dict of sha to culprits group, like app.iter_culprits()
+    yields them."""
+    groups = await blocking(get_cached_culprits, owner, repo, shas)
+    to_look_up = [sha for sha, group in groups.items() if group is None]
+    if not to_look_up:
+        return groups
+
+    if CULPRITS_BACKEND == "graphql":
+        try:
+            found = await graphql_culprits(owner, repo, to_look_up)
+        except ReadTimeout:
+            raise UpstreamError(
+                "Timeout error trying to load {}".format(GITHUB_GRAPHQL_URL)
+            )
+        except GraphQLError as exception:
+            raise UpstreamError(str(exception))
+        await blocking(set_cached_culprits, owner, repo, found)
+    else:
+        base_url, pulls_url = culprits_urls(owner, repo)
+        try:
+            pulls = await run_steps(pulls_steps(base_url, pulls_url, to_look_up))
+        except ReadTimeout:
+            raise UpstreamError("Timeout error trying to load {}".format(pulls_url))
+        # These store what they find.
+        found = dict(
+            zip(
+                to_look_up,
+                await asyncio.gather(
+                    *[
+                        run_steps(
+                            culprits_group_steps(
+                                base_url, owner, repo, sha, pulls.get(sha)
+                            )
+                        )
+                        for sha in to_look_up
+                    ]
+                ),
+            )
+        )
+    groups.update(found)
+    return groups
+
+
+async def compute_culprits(owner, repo, deployments):
+    names = culprits_names(deployments)
+    groups_by_sha = await find_culprits(owner, repo, list(names))
+    groups = []
+    for sha, name in names.items():
+        groups.append(dict(groups_by_sha[sha], name=name))
+    return {"culprits": groups}
+
+
+class Request:
+    """What the handlers need to know about an ASGI request."""
+
+    def __init__(self, scope, body):
+        self.args = MultiDict(
+            parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        )
+        self.headers = {name.lower(): value for name, value in self.headers_of(scope)}
+        self.body = body
+
+    @staticmethod
+    def headers_of(scope):
+        return [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        ]
+
+    @property
+    def json(self):
+        return json.loads(self.body)
+
+
+async def shas(request):
+    environment = request.json
+    owner = environment["owner"]
+    repo = environment["repo"]
+    revisions = [(each["name"], each["url"]) for each in environment["deployments"]]
+    force = bool(environment.get("refresh"))
+
+    result = None
+    if SNAPSHOTS and not force:
+        result = await blocking(
+            get_snapshot,
+            Snapshot.key,
+            content_hash(owner, repo, revisions),
+            Snapshot.shas,
+        )
+    if result is None:
+        try:
+            with deadline(REQUEST_DEADLINE):
+                result = await compute_shas(owner, repo, revisions, force)
+        except UpstreamError as exception:
+            return jsonify({"error": str(exception)})
+
+    result["tags"] = filter_tags(result["tags"], environment, result["deployments"])
+    return jsonify(result)
+
+
+async def culprits(request):
+    owner = request.json["owner"]
+    repo = request.json["repo"]
+    deployments = request.json["deployments"]
+
+    result = None
+    if SNAPSHOTS:
+        result = await blocking(
+            get_snapshot,
+            Snapshot.culprits_key,
+            culprits_snapshot_key(owner, repo, deployments),
+            Snapshot.culprits,
+        )
+    if result is None:
+        try:
+            with deadline(REQUEST_DEADLINE):
+                result = await compute_culprits(owner, repo, deployments)
+        except UpstreamError as exception:
+            return jsonify({"error": str(exception)})
+
+    return jsonify(result)
+
+
+async def githubapi_commits(request):
+    view = GitHubAPI()
+    response = await github_get(view.commits_url(request.args))
+    if response.status_code != 200:
+        abort(response.status_code, response.content)
+    return view.passthrough(
+        response,
+        parse_etags(request.headers.get("if-none-match")),
+        parse_accept_header(request.headers.get("accept-encoding")),
+    )
+
+
+class Application:
+    """The ASGI application. The routes here are handled by coroutines, the
+    rest by the Flask app."""
+
+    routes = {
+        ("POST", "/shas"): ("shas", shas),
+        ("POST", "/culprits"): ("culprits", culprits),
+        ("GET", "/githubapi/commits"): ("githubapi", githubapi_commits),
+    }
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        route = None
+        if scope["type"] == "http":
+            route = self.routes.get((scope["method"], scope["path"]))
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+
+        endpoint, handler = route
+        started = time.perf_counter()
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        # For jsonify() and make_response(), and Flask's error handling.
+        environ = EnvironBuilder(
+            path=scope["path"],
+            method=scope["method"],
+            query_string=scope["query_string"],
+            headers=Request.headers_of(scope),
+            data=body,
+        ).get_environ()
+        with self.flask_app.request_context(environ):
+            try:
+                response = await handler(Request(scope, body))
+            except Exception as exception:
+                response = self.handle_exception(exception)
+        metrics.observe(
+            "request_duration_seconds", time.perf_counter() - started, endpoint=endpoint
+        )
+        metrics.inc("responses_total", endpoint=endpoint, status=response.status_code)
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response.headers.items()
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    def handle_exception(self, exception):
+        """Respond like the Flask app would, with its error handlers (e.g.
+        503 and Retry-After for RateLimitExhausted) or else a 500."""
+        flask_app = self.flask_app
+        try:
+            return flask_app.make_response(flask_app.handle_user_exception(exception))
+        except Exception as unhandled:
+            return flask_app.handle_exception(unhandled)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                upstream.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await upstream.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+application = Application(whatsdeployed.create_app())
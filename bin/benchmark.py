@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""Measure how fast app.py answers its endpoints, entirely offline.
+
+A fake api.github.com (and fake deployment __version__ URLs) is started
+on localhost and the app is pointed at it, with its own throwaway SQLite
+database. Then each endpoint is hammered and the latencies, throughput and
+number of calls the fake GitHub got per request are reported.
+
+Any setting of the app can be tried with --env, for example:
+
+    ./bin/benchmark.py --latency 100 --env DEPLOYMENT_CACHE_TTL=5
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import click
+import requests
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ("shas", "culprits", "githubapi", "shortenit", "shortlink")
+OWNER = "bench"
+REPO = "mark"
+
+
+def fake_sha(i):
+    return hashlib.sha1(str(i).encode("utf-8")).hexdigest()
+
+
+def fake_user(login):
+    return {
+        "login": login,
+        "avatar_url": "https://example.com/{}.png".format(login),
+        "html_url": "https://github.com/{}".format(login),
+    }
+
+
+class FakeGitHub(ThreadingHTTPServer):
+    """Just enough of the GitHub REST and GraphQL APIs for app.py, plus
+    /deployments/<n>/__version__. Commit i has sha fake_sha(i), is tagged
+    if i < tags and is the merge commit of PR i if i < pulls."""
+
+    daemon_threads = True
+
+    def __init__(self, latency, tags, pulls, comments):
+        super().__init__(("127.0.0.1", 0), FakeGitHubHandler)
+        self.latency = latency
+        self.tags = [
+            {"name": "v{}".format(i), "commit": {"sha": fake_sha(i)}}
+            for i in range(tags)
+        ]
+        self.pulls = [
+            {
+                "number": i,
+                "merge_commit_sha": fake_sha(i),
+                "_links": {"html": {"href": "https://github.com/pull/{}".format(i)}},
+                "user": fake_user("author{}".format(i)),
+                "assignees": [fake_user("assignee")],
+            }
+            for i in range(pulls)
+        ]
+        self.comments = [
+            {"user": fake_user("commenter{}".format(i))} for i in range(comments)
+        ]
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_port)
+
+    def count(self):
+        with self.lock:
+            self.calls += 1
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Otherwise small responses wait for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, data, status=200, headers=None):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "4999")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def paginated(self, items, query, path):
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        headers = {}
+        if page < last_page:
+            url = "{}{}?".format(self.server.url, path)
+            headers["Link"] = '<{}>; rel="next", <{}>; rel="last"'.format(
+                url + urlencode({"page": page + 1, "per_page": per_page}),
+                url + urlencode({"page": last_page, "per_page": per_page}),
+            )
+        start = (page - 1) * per_page
+        self.respond(items[start:][:per_page], headers=headers)
+
+    def do_GET(self):
+        self.server.count()
+        time.sleep(self.server.latency)
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        path = parsed.path
+
+        match = re.match(r"/deployments/(\d+)/__version__$", path)
+        if match:
+            return self.respond({"commit": fake_sha(int(match.group(1)))})
+        match = re.match(r"/repos/[^/]+/[^/]+/(.*)$", path)
+        if not match:
+            return self.respond({"message": "Not Found"}, 404)
+        rest = match.group(1)
+        if rest == "tags":
+            return self.paginated(self.server.tags, query, path)
+        if rest == "pulls":
+            return self.paginated(self.server.pulls, query, path)
+        if rest == "commits":
+            return self.respond(
+                [
+                    {
+                        "sha": fake_sha(i),
+                        "commit": {"message": "Commit {}".format(i)},
+                        "author": fake_user("author{}".format(i)),
+                    }
+                    for i in range(int(query.get("per_page", ["30"])[0]))
+                ]
+            )
+        match = re.match(r"commits/(\w+)/pulls$", rest)
+        if match:
+            return self.respond(
+                [
+                    p
+                    for p in self.server.pulls
+                    if p["merge_commit_sha"] == match.group(1)
+                ]
+            )
+        match = re.match(r"commits/(\w+)$", rest)
+        if match:
+            return self.respond(
+                {
+                    "sha": match.group(1),
+                    "author": fake_user("committer"),
+                    "committer": fake_user("web-flow"),
+                }
+            )
+        match = re.match(r"issues/\d+/comments$", rest)
+        if match:
+            return self.respond(self.server.comments)
+        self.respond({"message": "Not Found"}, 404)
+
+    def do_POST(self):
+        self.server.count()
+        time.sleep(self.server.latency)
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        def actor(user):
+            return {
+                "login": user["login"],
+                "avatarUrl": user["avatar_url"],
+                "url": user["html_url"],
+            }
+
+        pulls = {p["merge_commit_sha"]: p for p in self.server.pulls}
+        repository = {}
+        for key, sha in payload["variables"].items():
+            if not key.startswith("sha"):
+                continue
+            nodes = []
+            # Like GitHub, a short sha will do.
+            full = [s for s in pulls if s.startswith(sha)]
+            if full:
+                pull = pulls[full[0]]
+                nodes.append(
+                    {
+                        "url": pull["_links"]["html"]["href"],
+                        "mergeCommit": {"oid": full[0]},
+                        "author": actor(pull["user"]),
+                        "assignees": {"nodes": [actor(a) for a in pull["assignees"]]},
+                        "comments": {
+                            "nodes": [
+                                {"author": actor(c["user"])}
+                                for c in self.server.comments
+                            ]
+                        },
+                    }
+                )
+            repository[key] = {
+                "author": {"user": actor(fake_user("committer"))},
+                "committer": {"user": actor(fake_user("web-flow"))},
+                "associatedPullRequests": {"nodes": nodes},
+            }
+        self.respond({"data": {"repository": repository}})
+
+
+def start_app(fake, env):
+    """Import app.py configured to only talk to 'fake' and serve it on a
+    random port in a thread. Return its base URL."""
+    os.environ.update(
+        {
+            "GITHUB_API_URL": fake.url,
+            "GITHUB_GRAPHQL_URL": fake.url + "/graphql",
+            "GITHUB_AUTH_TOKEN": "benchmark",
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+            + os.path.join(tempfile.mkdtemp(), "benchmark.sqlite"),
+        }
+    )
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import app
+
+    app.db.create_all()
+    # Don't print every request.
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = max(0, int(round(percent / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def run(fake, function, count, concurrency):
+    """Call 'function(i)' for i in range(count) with 'concurrency' threads.
+    Return the latencies, errors, seconds it all took and upstream calls."""
+    calls_before = fake.calls
+    latencies = []
+    errors = []
+
+    def timed(i):
+        started = time.perf_counter()
+        try:
+            function(i)
+        except Exception as exception:
+            errors.append(exception)
+        else:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(count)))
+    return latencies, errors, time.perf_counter() - started, fake.calls - calls_before
+
+
+@click.command()
+@click.option("--latency", default=50, help="Milliseconds the fake GitHub takes")
+@click.option("--tags", default=250, help="Number of tags in the fake repo")
+@click.option("--pulls", default=150, help="Number of merged PRs in the fake repo")
+@click.option("--comments", default=5, help="Number of comments on each PR")
+@click.option("--environments", default=3, help="Number of deployments per request")
+@click.option("-n", "--requests", "count", default=50, help="Requests per endpoint")
+@click.option("-c", "--concurrency", default=5, help="Concurrent requests")
+@click.option("--warmup", default=0, help="Requests per endpoint not measured")
+@click.option(
+    "-e",
+    "--endpoint",
+    "endpoints",
+    multiple=True,
+    type=click.Choice(ENDPOINTS),
+    help="Endpoint to benchmark (default all)",
+)
+@click.option("--env", multiple=True, help="KEY=VALUE setting for app.py")
+def cli(
+    latency,
+    tags,
+    pulls,
+    comments,
+    environments,
+    count,
+    concurrency,
+    warmup,
+    endpoints,
+    env,
+):
+    fake = FakeGitHub(latency / 1000, tags, pulls, comments)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    base_url = start_app(fake, dict(e.split("=", 1) for e in env))
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    # Spread the environments over the tagged and the PR merge commits.
+    deployments = [
+        {
+            "name": "env{}".format(i),
+            "url": "{}/deployments/{}/__version__".format(fake.url, i * 2),
+        }
+        for i in range(environments)
+    ]
+    url = "http://localhost:3000/?" + urlencode(
+        {
+            "owner": OWNER,
+            "repo": REPO,
+            "name[]": [d["name"] for d in deployments],
+            "url[]": [d["url"] for d in deployments],
+        },
+        True,
+    )
+
+    def post(path, data):
+        response = session.post(base_url + path, json=data)
+        response.raise_for_status()
+        return response.json()
+
+    shas = post("/shas", {"owner": OWNER, "repo": REPO, "deployments": deployments})
+    if shas.get("error"):
+        error_out(shas["error"])
+    link = post("/shortenit", {"url": url})["url"]
+
+    def shas_request(i):
+        post("/shas", {"owner": OWNER, "repo": REPO, "deployments": deployments})
+
+    def culprits_request(i):
+        post(
+            "/culprits",
+            {"owner": OWNER, "repo": REPO, "deployments": shas["deployments"]},
+        )
+
+    def githubapi_request(i):
+        session.get(
+            base_url + "/githubapi/commits",
+            params={"owner": OWNER, "repo": REPO, "per_page": 100},
+        ).raise_for_status()
+
+    def shortenit_request(i):
+        # Half of them are new.
+        post("/shortenit", {"url": url + "&name[]=new&url[]={}".format(i // 2)})
+
+    def shortlink_request(i):
+        response = session.get(base_url + link, allow_redirects=False)
+        if response.status_code != 302:
+            response.raise_for_status()
+
+    functions = {
+        "shas": shas_request,
+        "culprits": culprits_request,
+        "githubapi": githubapi_request,
+        "shortenit": shortenit_request,
+        "shortlink": shortlink_request,
+    }
+
+    click.echo(
+        "{:<10} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+            "endpoint",
+            "requests",
+            "errors",
+            "p50 ms",
+            "p95 ms",
+            "p99 ms",
+            "req/s",
+            "upstream",
+        )
+    )
+    for endpoint in endpoints or ENDPOINTS:
+        function = functions[endpoint]
+        if warmup:
+            run(fake, function, warmup, concurrency)
+        latencies, errors, seconds, calls = run(fake, function, count, concurrency)
+        latencies.sort()
+        click.echo(
+            "{:<10} {:>8} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.2f}".format(
+                endpoint,
+                count,
+                len(errors),
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                count / seconds,
+                calls / count,
+            )
+        )
+        if errors:
+            error_out("  First error: {}".format(errors[0]), raise_abort=False)
+    click.echo("('upstream' is calls to the fake GitHub per request)")
+
+
+def error_out(msg, raise_abort=True):
+    click.echo(click.style(msg, fg="red"))
+    if raise_abort:
+        raise click.Abort
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Post recorded GitHub webhook payloads to a running backend, signed the
+way GitHub signs them, e.g.:
+
+    ./bin/replay-webhook.py --event push push.json
+
+A payload can be copied from the "Recent Deliveries" tab of the webhook's
+settings on GitHub.
+"""
+import hmac
+import json
+import uuid
+
+import click
+import requests
+from decouple import config
+
+
+@click.command()
+@click.option(
+    "-e",
+    "--event",
+    required=True,
+    help="The X-GitHub-Event, e.g. push, create, pull_request or release",
+)
+@click.option(
+    "-u",
+    "--url",
+    default="http://localhost:5000/webhooks/github",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--secret",
+    default=config("GITHUB_WEBHOOK_SECRET", default=None),
+    help="Defaults to GITHUB_WEBHOOK_SECRET",
+)
+@click.argument("payloads", nargs=-1, required=True, type=click.File("rb"))
+def cli(event, url, secret, payloads):
+    if not secret:
+        raise click.BadParameter("No secret and no GITHUB_WEBHOOK_SECRET")
+    for payload in payloads:
+        body = payload.read()
+        signature = hmac.new(secret.encode("utf-8"), body, "sha256").hexdigest()
+        r = requests.post(
+            url,
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "X-GitHub-Event": event,
+                "X-GitHub-Delivery": str(uuid.uuid4()),
+                "X-Hub-Signature-256": "sha256=" + signature,
+            },
+        )
+        click.echo("{} {}".format(payload.name, r.status_code))
+        if r.headers.get("Content-Type") == "application/json":
+            click.echo(json.dumps(r.json(), indent=2))
+        else:
+            click.echo(r.text)
+
+
+if __name__ == "__main__":
+    cli()
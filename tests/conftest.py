@@ -0,0 +1,123 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The fake GitHub of the benchmark, which app.py is pointed at before it's
+# imported (it reads its settings then).
+spec = importlib.util.spec_from_file_location(
+    "benchmark", os.path.join(ROOT, "bin", "benchmark.py")
+)
+benchmark = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(benchmark)
+
+fake = benchmark.FakeGitHub(latency=0, tags=250, pulls=150, comments=3)
+threading.Thread(target=fake.serve_forever, daemon=True).start()
+os.environ.update(
+    {
+        "GITHUB_API_URL": fake.url,
+        "GITHUB_GRAPHQL_URL": fake.url + "/graphql",
+        "GITHUB_AUTH_TOKEN": "test",
+        "GITHUB_WEBHOOK_SECRET": "secret",
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+        + os.path.join(tempfile.mkdtemp(), "test.sqlite"),
+    }
+)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+app.db.create_all()
+original_tags = list(fake.tags)
+
+
+def delete_nothing(table):
+    """Make the DELETEs of a table match nothing, like when another process
+    deletes a key and then sets it at the same time as this one."""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        if statement.startswith("DELETE FROM {} ".format(table)):
+            statement += " AND 0"
+        return statement, parameters
+
+    event.listen(
+        app.db.engine, "before_cursor_execute", before_cursor_execute, retval=True
+    )
+    return lambda: event.remove(
+        app.db.engine, "before_cursor_execute", before_cursor_execute
+    )
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    """Every test starts without anything stored or cached."""
+    fake.tags[:] = original_tags
+    for model in (
+        app.TagIndex,
+        app.ShaResult,
+        app.CachedResponse,
+        app.Shortlink,
+        app.Snapshot,
+    ):
+        app.db.session.query(model).delete()
+    app.db.session.commit()
+    if app.github_cache is not None:
+        app.github_cache.backend = type(app.github_cache.backend)(
+            app.GITHUB_CACHE_MAX_BYTES
+        )
+    yield
+
+
+class FlaskClient:
+    def __init__(self):
+        self.client = app.app.test_client()
+
+    def request(self, method, path, json=None, headers=None):
+        response = self.client.open(path, method=method, json=json, headers=headers)
+        return response.status_code, response.headers, response.get_json()
+
+
+class AsgiClient:
+    def __init__(self):
+        httpx = pytest.importorskip("httpx")
+        pytest.importorskip("asgiref")
+        import asgi
+
+        self.httpx = httpx
+        self.asgi = asgi
+
+    def request(self, method, path, json=None, headers=None):
+        async def send():
+            transport = self.httpx.ASGITransport(app=self.asgi.application)
+            async with self.httpx.AsyncClient(
+                transport=transport, base_url="http://testserver"
+            ) as client:
+                try:
+                    return await client.request(
+                        method, path, json=json, headers=headers
+                    )
+                finally:
+                    # It belongs to this event loop.
+                    await self.asgi.upstream.close()
+
+        response = asyncio.run(send())
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        return response.status_code, response.headers, data
+
+
+@pytest.fixture(params=["flask", "asgi"])
+def client(request):
+    """The same requests, to the Flask app and to asgi.py."""
+    if request.param == "flask":
+        return FlaskClient()
+    return AsgiClient()
@@ -0,0 +1,42 @@
+import pytest
+import requests
+
+import app
+
+
+def timeout():
+    raise requests.exceptions.ReadTimeout("slow")
+
+
+def test_opens_after_threshold():
+    breaker = app.CircuitBreaker(2, 30)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            breaker.call("x", timeout)
+    with pytest.raises(app.CircuitOpen):
+        breaker.call("x", timeout)
+    assert breaker.stats() == {"open": ["x"], "rejected": 1}
+
+
+def test_timeouts_cut_short_by_the_deadline_dont_count():
+    breaker = app.CircuitBreaker(1, 30)
+    with app.deadline(app.GITHUB_REQUEST_TIMEOUT / 2):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            breaker.call("x", timeout)
+    assert breaker.stats()["open"] == []
+    with app.deadline(app.GITHUB_REQUEST_TIMEOUT * 2):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            breaker.call("x", timeout)
+    assert breaker.stats()["open"] == ["x"]
+
+
+def test_success_resets():
+    breaker = app.CircuitBreaker(2, 30)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        breaker.call("x", timeout)
+    response = requests.Response()
+    response.status_code = 200
+    assert breaker.call("x", lambda: response) is response
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        breaker.call("x", timeout)
+    assert breaker.stats()["open"] == []
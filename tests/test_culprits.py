@@ -0,0 +1,118 @@
+import pytest
+
+import app
+
+
+def actor(login):
+    return {
+        "login": login,
+        "avatarUrl": "https://avatars/{}".format(login),
+        "url": "https://github.com/{}".format(login),
+    }
+
+
+def user(login):
+    return {
+        "login": login,
+        "avatar_url": "https://avatars/{}".format(login),
+        "html_url": "https://github.com/{}".format(login),
+    }
+
+
+def commit(author, committer, pulls=()):
+    return {
+        "author": {"user": author},
+        "committer": {"user": committer},
+        "associatedPullRequests": {"nodes": list(pulls)},
+    }
+
+
+def pull(sha, author, assignees=(), commenters=()):
+    return {
+        "url": "https://github.com/o/r/pull/1",
+        "mergeCommit": {"oid": sha},
+        "author": author,
+        "assignees": {"nodes": list(assignees)},
+        "comments": {"nodes": [{"author": a} for a in commenters]},
+    }
+
+
+def test_culprits_from_graphql():
+    payload = {
+        "data": {
+            "repository": {
+                "sha0": commit(
+                    actor("alice"),
+                    actor("web-flow"),
+                    [
+                        pull("other", actor("mallory")),
+                        pull("a" * 40, actor("alice"), [actor("bob")], [actor("eve")]),
+                    ],
+                ),
+                "sha1": commit(actor("carol"), actor("dave")),
+            }
+        }
+    }
+    groups = app.culprits_from_graphql("o", "r", ["a" * 40, "b" * 40], payload)
+    assert groups["a" * 40] == {
+        "users": [
+            ("Author & Committer", user("alice")),
+            ("Assignee", user("bob")),
+            ("Commenter", user("eve")),
+        ],
+        "links": ["https://github.com/o/r/pull/1"],
+    }
+    assert groups["b" * 40] == {
+        "users": [("Author", user("carol")), ("Committer", user("dave"))],
+        "links": [],
+    }
+
+
+def test_culprits_from_graphql_deleted_accounts():
+    payload = {
+        "data": {
+            "repository": {
+                "sha0": commit(
+                    None, actor("web-flow"), [pull("a" * 40, None, [None], [None])]
+                ),
+            }
+        }
+    }
+    groups = app.culprits_from_graphql("o", "r", ["a" * 40], payload)
+    assert groups["a" * 40] == {
+        "users": [],
+        "links": ["https://github.com/o/r/pull/1"],
+    }
+
+
+def test_culprits_from_graphql_errors():
+    with pytest.raises(app.GraphQLError) as exc_info:
+        app.culprits_from_graphql(
+            "o", "r", ["a" * 40], {"data": None, "errors": [{"message": "Nope"}]}
+        )
+    assert str(exc_info.value) == "Nope"
+    with pytest.raises(app.GraphQLError):
+        app.culprits_from_graphql(
+            "o", "r", ["a" * 40], {"data": {"repository": {"sha0": None}}}
+        )
+
+
+def test_culprits_graphql_query_short_shas():
+    query = app.culprits_graphql_query("o", "r", ["abc1234"])
+    assert "object(expression: $sha0)" in query["query"]
+    assert "$sha0: String!" in query["query"]
+    assert query["variables"]["sha0"] == "abc1234"
+
+
+def test_culprits_from_graphql_short_sha():
+    payload = {
+        "data": {
+            "repository": {
+                "sha0": commit(
+                    actor("alice"), actor("bob"), [pull("abc1234" + "0" * 33, None)]
+                ),
+            }
+        }
+    }
+    groups = app.culprits_from_graphql("o", "r", ["ABC1234"], payload)
+    assert groups["ABC1234"]["links"] == ["https://github.com/o/r/pull/1"]
@@ -0,0 +1,261 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from conftest import AsgiClient, benchmark, fake
+
+import app
+
+fake_sha = benchmark.fake_sha
+
+
+def deployments(*numbers):
+    return [
+        {
+            "name": "env{}".format(number),
+            "url": "{}/deployments/{}/__version__".format(fake.url, number),
+        }
+        for number in numbers
+    ]
+
+
+def shas(client, *numbers):
+    status, _, data = client.request(
+        "POST",
+        "/shas",
+        json={"owner": "o", "repo": "r", "deployments": deployments(*numbers)},
+    )
+    assert status == 200
+    return data
+
+
+def test_shas(client):
+    data = shas(client, 0, 3)
+    assert [d["sha"] for d in data["deployments"]] == [fake_sha(0), fake_sha(3)]
+    assert len(data["tags"]) == len(fake.tags)
+    assert data["tags"][fake_sha(3)] == "v3"
+
+
+def test_shas_error(client):
+    status, _, data = client.request(
+        "POST",
+        "/shas",
+        json={
+            "owner": "o",
+            "repo": "r",
+            "deployments": [{"name": "x", "url": fake.url + "/nope"}],
+        },
+    )
+    assert status == 200
+    assert data["error"] == "404 trying to load {}/nope".format(fake.url)
+
+
+@pytest.fixture
+def stale_tags(monkeypatch):
+    """Check GitHub for changed tags on every request."""
+    monkeypatch.setattr(app, "TAG_INDEX_MAX_AGE", 0)
+
+
+def test_fresh_tag_index(client):
+    shas(client, 0)
+    calls = fake.calls
+    fake.tags.insert(0, {"name": "v999", "commit": {"sha": fake_sha(999)}})
+    data = shas(client, 0)
+    # Only the deployment. The tags are as they were.
+    assert fake.calls == calls + 1
+    assert fake_sha(999) not in data["tags"]
+
+
+def test_new_tags(client, stale_tags):
+    shas(client, 0)
+    fake.tags.insert(0, {"name": "v999", "commit": {"sha": fake_sha(999)}})
+    data = shas(client, 0)
+    assert data["tags"][fake_sha(999)] == "v999"
+    assert len(data["tags"]) == len(fake.tags)
+
+
+def test_culprits(client):
+    status, _, data = client.request(
+        "POST",
+        "/culprits",
+        json={
+            "owner": "o",
+            "repo": "r",
+            "deployments": shas(client, 1, 200)["deployments"],
+        },
+    )
+    assert status == 200
+    first, second = data["culprits"]
+    assert first["name"] == "env1"
+    assert first["links"] == ["https://github.com/pull/1"]
+    assert ["Author", benchmark.fake_user("author1")] in first["users"]
+    # There's no pull request for that one, only the commit.
+    assert second["links"] == []
+    assert second["users"][0][1]["login"] == "committer"
+
+
+def test_culprits_are_the_same_in_both_modes(client):
+    """Whatever computed them, the Flask app gives the same culprits."""
+    body = {"owner": "o", "repo": "r", "deployments": shas(client, 2)["deployments"]}
+    _, _, data = client.request("POST", "/culprits", json=body)
+    app.db.session.query(app.ShaResult).delete()
+    app.db.session.commit()
+    expected = app.app.test_client().post("/culprits", json=body).get_json()
+    assert data == expected
+
+
+def test_culprits_graphql_short_shas(client, monkeypatch):
+    """Deployments often only report the start of the sha."""
+    monkeypatch.setattr(app, "CULPRITS_BACKEND", "graphql")
+    if isinstance(client, AsgiClient):
+        monkeypatch.setattr(client.asgi, "CULPRITS_BACKEND", "graphql")
+    status, _, data = client.request(
+        "POST",
+        "/culprits",
+        json={
+            "owner": "o",
+            "repo": "r",
+            "deployments": [{"name": "env1", "sha": fake_sha(1)[:7]}],
+        },
+    )
+    assert status == 200
+    (culprit,) = data["culprits"]
+    assert culprit["links"] == ["https://github.com/pull/1"]
+
+
+def test_githubapi_commits(client):
+    url = "/githubapi/commits?owner=o&repo=r&per_page=5"
+    status, headers, data = client.request("GET", url)
+    assert status == 200
+    assert len(data) == 5
+    status, _, _ = client.request(
+        "GET", url, headers={"If-None-Match": headers["ETag"]}
+    )
+    assert status == 304
+
+
+def test_rate_limit_exhausted(client, monkeypatch):
+    def acquire(resource="core"):
+        raise app.RateLimitExhausted(30)
+
+    monkeypatch.setattr(app.token_pool, "acquire", acquire)
+    status, headers, data = client.request(
+        "GET", "/githubapi/commits?owner=o&repo=r&per_page=5"
+    )
+    assert status == 503
+    assert headers["Retry-After"] == "31"
+    assert "rate limit" in data["error"]
+
+
+def test_backported_tag(client, stale_tags):
+    """GitHub lists tags by name so a new one can be on any page."""
+    shas(client, 0)
+    fake.tags.insert(150, {"name": "v1.0.1", "commit": {"sha": fake_sha(1001)}})
+    data = shas(client, 0)
+    assert data["tags"][fake_sha(1001)] == "v1.0.1"
+
+
+def test_deleted_tag(client, stale_tags):
+    shas(client, 0)
+    del fake.tags[3]
+    data = shas(client, 0)
+    assert fake_sha(3) not in data["tags"]
+    assert len(data["tags"]) == len(fake.tags)
+
+
+def test_unchanged_tags(client, stale_tags):
+    shas(client, 0)
+    calls = fake.calls
+    data = shas(client, 0)
+    assert len(data["tags"]) == len(fake.tags)
+    # The deployment and the pages of tags, nothing else.
+    assert fake.calls == calls + 1 + 3
+    row = app.TagIndex.query.one()
+    assert row.complete
+    assert len(json.loads(row.etags)) == 3
+
+
+def test_shas_invalid_url(client):
+    status, _, data = client.request(
+        "POST",
+        "/shas",
+        json={
+            "owner": "o",
+            "repo": "r",
+            "deployments": [{"name": "x", "url": "example.com/version.json"}],
+        },
+    )
+    assert status == 200
+    assert data["error"] == "Unable to load example.com/version.json"
+
+
+def test_shas_stream():
+    body = {
+        "owner": "o",
+        "repo": "r",
+        "deployments": deployments(1)
+        + [{"name": "x", "url": "example.com/version.json"}],
+    }
+    response = app.app.test_client().post("/shas/stream", json=body)
+    records = [json.loads(line) for line in response.get_data().splitlines()]
+    assert [r["type"] for r in records][-2:] == ["tags", "summary"]
+    by_type = {r["type"]: r for r in records}
+    assert by_type["deployment"]["deployment"]["sha"] == fake_sha(1)
+    assert by_type["error"]["error"] == "Unable to load example.com/version.json"
+    assert by_type["summary"]["deployments"] == 1
+    assert by_type["summary"]["errors"] == 1
+
+
+class SlowDripHandler(BaseHTTPRequestHandler):
+    """A deployment URL that sends a byte every 0.1 seconds, for ever."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(b" ")
+                self.wfile.flush()
+                time.sleep(0.1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def slow_drip():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowDripHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}/".format(server.server_port)
+    server.shutdown()
+
+
+def test_slow_drip_deployment(client, slow_drip, monkeypatch):
+    monkeypatch.setattr(app, "GITHUB_REQUEST_TIMEOUT", 0.5)
+    url = slow_drip + "?" + type(client).__name__
+    t0 = time.time()
+    status, _, data = client.request(
+        "POST",
+        "/shas",
+        json={"owner": "o", "repo": "r", "deployments": [{"name": "x", "url": url}]},
+    )
+    assert status == 200
+    assert data["error"] == "Timeout error trying to load {}".format(url)
+    assert time.time() - t0 < 2
+
+
+def test_githubapi_circuit_open(client, monkeypatch):
+    def check(key):
+        raise app.CircuitOpen("GitHub failed recently")
+
+    monkeypatch.setattr(app.github_breaker, "check", check)
+    status, _, data = client.request(
+        "GET", "/githubapi/commits?owner=o&repo=r&per_page=5"
+    )
+    assert status == 503
+    assert data == {"error": "GitHub failed recently"}
@@ -0,0 +1,44 @@
+import time
+
+from conftest import delete_nothing
+
+import app
+
+
+def entry(body):
+    return app.CacheEntry("https://api.github.com/x", '"etag"', {"ETag": "x"}, body)
+
+
+def test_database_backend():
+    backend = app.DatabaseCacheBackend(1000)
+    assert backend.get("key") is None
+    backend.set("key", entry(b"body"))
+    assert backend.get("key") == entry(b"body")
+    assert len(backend) == 1
+    backend.delete("key")
+    assert backend.get("key") is None
+
+
+def test_database_backend_set_at_the_same_time():
+    backend = app.DatabaseCacheBackend(1000)
+    backend.set("key", entry(b"theirs"))
+    undo = delete_nothing("cached_response")
+    try:
+        backend.set("key", entry(b"mine"))
+    finally:
+        undo()
+    assert backend.get("key") == entry(b"theirs")
+
+
+def test_database_backend_evicts_now_and_then(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    backend = app.DatabaseCacheBackend(10)
+    backend.set("a", entry(b"0123456789"))
+    now += 1
+    backend.set("b", entry(b"0123456789"))
+    assert len(backend) == 2
+    now += backend.EVICT_INTERVAL
+    backend.set("c", entry(b"0123456789"))
+    assert len(backend) == 1
+    assert backend.get("c") == entry(b"0123456789")
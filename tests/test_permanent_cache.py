@@ -0,0 +1,63 @@
+import time
+
+from conftest import delete_nothing
+
+import app
+
+
+def last_used(key):
+    table = app.ShaResult.__table__
+    with app.db.engine.begin() as connection:
+        return connection.execute(
+            app.db.select([table.c.last_used]).where(table.c.key == key)
+        ).scalar()
+
+
+def test_get_set_delete():
+    cache = app.PermanentCache(1000)
+    assert cache.get("commit:Peterbe/WhatsDeployed:abc") is None
+    cache.set("commit:Peterbe/WhatsDeployed:abc", {"a": 1})
+    assert cache.get("commit:peterbe/whatsdeployed:abc") == {"a": 1}
+    cache.delete("commit:PETERBE/whatsdeployed:abc")
+    assert cache.get("commit:peterbe/whatsdeployed:abc") is None
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_hits_touch_last_used_now_and_then(monkeypatch):
+    cache = app.PermanentCache(1000)
+    cache.set("key", "value")
+    set_at = last_used("key")
+    cache.get("key")
+    assert last_used("key") == set_at
+    monkeypatch.setattr(time, "time", lambda: set_at + cache.TOUCH_INTERVAL)
+    cache.get("key")
+    assert last_used("key") == set_at + cache.TOUCH_INTERVAL
+
+
+def test_eviction_now_and_then(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = app.PermanentCache(20)
+    cache.set("a", "0123456789")
+    now += 1
+    cache.set("b", "0123456789")
+    now += 1
+    cache.set("c", "0123456789")
+    # Not yet, it was just done.
+    assert cache.get("a") == "0123456789"
+    now += cache.EVICT_INTERVAL
+    cache.set("d", "0123456789")
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("d") == "0123456789"
+
+
+def test_set_at_the_same_time():
+    cache = app.PermanentCache(1000)
+    cache.set("key", "theirs")
+    undo = delete_nothing("sha_result")
+    try:
+        cache.set("key", "mine")
+    finally:
+        undo()
+    assert cache.get("key") == "theirs"
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+import app
+
+SHA = "a" * 40
+OTHER = "b" * 40
+
+
+def read(body, chunk_size=7):
+    reader = app.ShaReader(1000)
+    body = body.encode("utf-8")
+    chunks = [body[i:][:chunk_size] for i in range(0, len(body), chunk_size)]
+    for chunk in chunks:
+        if reader.feed(chunk):
+            break
+    return reader.result()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        SHA,
+        json.dumps({"commit": SHA, "version": "1.0"}),
+        json.dumps({"source": "x", "build": {"commit": OTHER}, "commit": SHA}),
+        json.dumps({"notes": '"commit": "{}"'.format(OTHER), "commit": SHA}),
+        json.dumps({"list": [{"commit": OTHER}], "commit": SHA}),
+    ],
+)
+def test_sha(body):
+    assert read(body) == SHA
+
+
+def test_stops_early():
+    reader = app.ShaReader(1000)
+    assert reader.feed(json.dumps({"commit": SHA}).encode("utf-8")[:-1])
+    assert reader.result() == SHA
+
+
+def test_no_top_level_commit():
+    assert read(json.dumps({"build": {"commit": OTHER}})) is None
+
+
+@pytest.mark.parametrize("body", ["<html>{}</html>".format(SHA), "x" * 41])
+def test_rejected(body):
+    assert read(body) is None
@@ -0,0 +1,158 @@
+import json
+from urllib.parse import urlencode
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import app
+
+
+def shorten(owner="o", repo="r", names=("prod",)):
+    url = "https://whatsdeployed.io/?" + urlencode(
+        {
+            "owner": owner,
+            "repo": repo,
+            "name[]": list(names),
+            "url[]": ["https://{}.example.com/__version__".format(n) for n in names],
+        },
+        doseq=True,
+    )
+    response = app.app.test_client().post("/shortenit", json={"url": url})
+    assert response.status_code == 200
+    return response.get_json()["url"]
+
+
+def code(url):
+    return url.replace("/s-", "", 1)
+
+
+def test_encode_link():
+    codes = [app.encode_link(id_) for id_ in range(1, 5000)]
+    assert len(set(codes)) == len(codes)
+    # Never 3 characters, like the old random codes.
+    assert min(map(len, codes)) == 4
+    assert len(app.encode_link(len(app.LINK_ALPHABET) ** 4)) == 5
+
+
+def test_shorten():
+    url = shorten()
+    assert url == "/s-{}".format(app.encode_link(1))
+    response = app.app.test_client().get("/lengthenit/" + code(url))
+    assert response.get_json() == {
+        "owner": "o",
+        "repo": "r",
+        "deployments": [
+            {"name": "prod", "url": "https://prod.example.com/__version__"}
+        ],
+    }
+
+
+def test_shorten_again():
+    url = shorten()
+    assert shorten() == url
+    assert shorten(names=("prod", "stage")) != url
+    assert app.Shortlink.query.count() == 2
+
+
+def test_shorten_at_the_same_time():
+    """If another process shortens the same thing between looking for it
+    and inserting it, theirs is used."""
+    hash_ = app.content_hash(
+        "o", "r", [("prod", "https://prod.example.com/__version__")]
+    )
+
+    inserted = []
+
+    def before_flush(session, *args):
+        if inserted:
+            return
+        inserted.append(True)
+        with app.db.engine.begin() as connection:
+            connection.execute(
+                app.Shortlink.__table__.insert().values(
+                    link="theirs",
+                    owner="o",
+                    repo="r",
+                    revisions="[]",
+                    content_hash=hash_,
+                )
+            )
+
+    event.listen(Session, "before_flush", before_flush)
+    try:
+        assert shorten() == "/s-theirs"
+    finally:
+        event.remove(Session, "before_flush", before_flush)
+    assert app.Shortlink.query.count() == 1
+
+
+@pytest.fixture
+def legacy_shortlinks():
+    """A shortlink table from before Shortlink.content_hash."""
+    app.db.session.remove()
+    app.Shortlink.__table__.drop(app.db.engine)
+    with app.db.engine.begin() as connection:
+        connection.execute(
+            app.db.text(
+                "CREATE TABLE shortlink (id INTEGER NOT NULL PRIMARY KEY, "
+                "link VARCHAR(80) UNIQUE, owner VARCHAR(200), "
+                "repo VARCHAR(200), revisions TEXT)"
+            )
+        )
+        for id_, link, revisions in (
+            (1, "abc", [["prod", "https://prod"]]),
+            (2, "xyz", [["prod", "https://prod"]]),
+            (3, "def", [["stage", "https://stage"]]),
+        ):
+            connection.execute(
+                app.db.text(
+                    "INSERT INTO shortlink VALUES (:id, :link, 'o', 'r', :revisions)"
+                ),
+                {"id": id_, "link": link, "revisions": json.dumps(revisions)},
+            )
+    yield
+    app.db.session.remove()
+    app.Shortlink.__table__.drop(app.db.engine)
+    app.Shortlink.__table__.create(app.db.engine)
+
+
+def test_migrate_shortlinks(legacy_shortlinks):
+    assert app.migrate_shortlinks() == 2
+    assert app.migrate_shortlinks() == 0
+    hashes = {
+        shortlink.link: shortlink.content_hash
+        for shortlink in app.Shortlink.query.all()
+    }
+    assert hashes == {
+        "abc": app.content_hash("o", "r", [["prod", "https://prod"]]),
+        # The newer duplicate still works, but isn't handed out again.
+        "xyz": None,
+        "def": app.content_hash("o", "r", [["stage", "https://stage"]]),
+    }
+    app.db.session.remove()
+    with pytest.raises(IntegrityError):
+        with app.db.engine.begin() as connection:
+            connection.execute(
+                app.Shortlink.__table__.insert().values(
+                    link="new", content_hash=hashes["abc"]
+                )
+            )
+
+
+def test_shortlink_cache():
+    first = code(shorten())
+    second = code(shorten(names=("stage",)))
+    cache = app.ShortlinkCache(1)
+    assert cache.get("nope") is None
+    assert cache.get(first).revisions == [
+        ["prod", "https://prod.example.com/__version__"]
+    ]
+    assert set(cache.get_many([first, second, "nope"])) == {first, second}
+    # Only the most recently used one is kept.
+    assert list(cache.entries) == [second]
+    assert cache.get(second).link == second
+    assert cache.stats() == {"entries": 1, "hits": 2, "misses": 4}
+    cache.invalidate(second)
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,47 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import benchmark, fake
+
+import app
+
+
+def shortlink(number):
+    revisions = [
+        ["env{}".format(number), "{}/deployments/{}/__version__".format(fake.url, n)]
+        for n in (number, number + 1)
+    ]
+    link = "l{}".format(number)
+    app.db.session.add(app.Shortlink(link, "o", "r", revisions))
+    app.db.session.commit()
+    app.record_hit(app.ResolvedShortlink(link, "o", "r", revisions))
+    return link
+
+
+def test_refresh_snapshots(monkeypatch):
+    # More shortlinks than the coordinator has threads.
+    monkeypatch.setattr(app, "coordinator", ThreadPoolExecutor(max_workers=2))
+    links = [shortlink(number) for number in range(3)]
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(
+            app.app.test_cli_runner().invoke(args=["refresh-snapshots", "--once"])
+        ),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "refresh-snapshots hangs"
+    assert result[0].exit_code == 0, result[0].output
+    assert "Refreshed 3 snapshots" in result[0].output
+
+    for number, link in enumerate(links):
+        snapshot = app.Snapshot.query.filter_by(link=link).one()
+        shas = json.loads(snapshot.shas)
+        assert [d["sha"] for d in shas["deployments"]] == [
+            benchmark.fake_sha(number),
+            benchmark.fake_sha(number + 1),
+        ]
+        assert len(json.loads(snapshot.culprits)["culprits"]) == 2
+    app.db.session.rollback()
@@ -0,0 +1,23 @@
+import gzip
+
+import app
+
+
+def test_compressed_at_load(tmp_path):
+    (tmp_path / "main.js").write_text("console.log('hi');\n" * 100)
+    (tmp_path / "main.js.map").write_text('{"mappings": "AAAA"}\n' * 100)
+    # Would compress fine, but images aren't worth the startup time.
+    (tmp_path / "logo.png").write_bytes(b"\0" * 10000)
+    assets = app.StaticAssets(str(tmp_path))
+    script = assets.get("main.js")
+    assert gzip.decompress(script.bodies["gzip"]) == script.bodies[None]
+    assert "gzip" in assets.get("main.js.map").bodies
+    assert list(assets.get("logo.png").bodies) == [None]
+
+
+def test_precompressed(tmp_path):
+    (tmp_path / "logo.png").write_bytes(b"\0" * 10000)
+    (tmp_path / "logo.png.br").write_bytes(b"brotli")
+    assets = app.StaticAssets(str(tmp_path))
+    assert len(assets) == 1
+    assert assets.get("logo.png").bodies["br"] == b"brotli"
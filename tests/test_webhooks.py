@@ -0,0 +1,96 @@
+import hmac
+import json
+
+import app
+
+
+def post(event, payload, secret="secret"):
+    body = json.dumps(payload).encode("utf-8")
+    signature = hmac.new(secret.encode("utf-8"), body, "sha256").hexdigest()
+    return app.app.test_client().post(
+        "/webhooks/github",
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "X-GitHub-Event": event,
+            "X-Hub-Signature-256": "sha256=" + signature,
+        },
+    )
+
+
+def repository(owner="Peterbe", repo="WhatsDeployed"):
+    return {"repository": {"owner": {"login": owner}, "name": repo}}
+
+
+def test_verify_signature():
+    body = b'{"zen": "Keep it logically awesome."}'
+    signature = "sha256=" + hmac.new(b"secret", body, "sha256").hexdigest()
+    assert app.verify_signature("secret", body, signature)
+    assert not app.verify_signature("other", body, signature)
+    assert not app.verify_signature("secret", body + b" ", signature)
+    assert not app.verify_signature("secret", body, None)
+
+
+def test_bad_signature():
+    assert post("ping", repository(), secret="wrong").status_code == 403
+
+
+def test_unhandled_event():
+    r = post("ping", dict(repository(), zen="Hi"))
+    assert r.status_code == 200
+    assert r.get_json() == {"event": "ping", "done": []}
+
+
+def test_handlers():
+    assert sorted(app.WEBHOOK_HANDLERS) == [
+        "create",
+        "delete",
+        "pull_request",
+        "push",
+        "release",
+    ]
+
+
+def tag_index_refreshed():
+    row = app.TagIndex.query.one()
+    app.db.session.rollback()
+    return row.refreshed
+
+
+def test_tag_events_mark_the_tag_index_stale():
+    app.write_tag_index("peterbe", "whatsdeployed", None, [], True, None, True)
+    payloads = [
+        ("push", dict(repository(), ref="refs/tags/v1")),
+        ("create", dict(repository(), ref="v1", ref_type="tag")),
+        ("delete", dict(repository(), ref="v1", ref_type="tag")),
+        ("release", dict(repository(), action="published", release={"tag_name": "v1"})),
+    ]
+    for event, payload in payloads:
+        with app.db.engine.begin() as connection:
+            connection.execute(app.TagIndex.__table__.update().values(refreshed=1))
+        r = post(event, payload)
+        assert r.get_json() == {"event": event, "done": ["tag index stale"]}
+        assert tag_index_refreshed() == 0
+
+
+def test_branch_events_do_nothing():
+    r = post("push", dict(repository(), ref="refs/heads/main"))
+    assert r.get_json() == {"event": "push", "done": []}
+    r = post("create", dict(repository(), ref="main", ref_type="branch"))
+    assert r.get_json() == {"event": "create", "done": []}
+
+
+def test_pull_request_forgets_the_culprits():
+    key = app.culprits_cache_key("peterbe", "whatsdeployed", "a" * 40)
+    app.permanent_cache.set(key, {"users": [], "links": []})
+    r = post(
+        "pull_request",
+        dict(
+            repository(),
+            action="closed",
+            number=7,
+            pull_request={"merge_commit_sha": "a" * 40},
+        ),
+    )
+    assert r.get_json()["done"][-1] == "culprits of {} forgotten".format("a" * 40)
+    assert app.permanent_cache.get(key) is None